@@ -0,0 +1,248 @@
+#!/usr/bin/python
+"""Compare the solvers in process.py on synthetic surveys.
+
+Each engine runs for BUDGET seconds on each of the surveys in
+SURVEYS, one at a time.  Every time it finds a better allocation,
+we record the elapsed time, the number of full evaluations so far,
+and the score.  The curves go in CURVEFILE, one row per record, and
+the summary shows the mean evaluations per run, the mean best score
+at each of the CHECKPOINTS, and the range of the final scores.
+
+The islands engine runs one search per CPU, so its evaluations are
+the total over all of them.
+
+python benchmark.py [budget] [engine ...]
+"""
+
+import os
+import sys
+import csv
+import time
+import random
+import multiprocessing
+
+import process
+from process import Survey, Project, Student
+
+# (seed, number of students, number of projects) for each survey
+SURVEYS = [(1, 60, 10), (2, 60, 10), (3, 120, 20)]
+
+BUDGET = 60
+CHECKPOINTS = [1, 2, 5, 10, 30, 60, 120, 300]
+CURVEFILE = 'benchmark.csv'
+
+
+def make_survey(seed, n, p):
+    """make a random survey with n students and p projects, the
+    first of which is restricted; the same seed makes the same
+    survey"""
+    rng = random.Random(seed)
+    survey = Survey(None)
+    survey.skills = ['Machine Shop', 'Programming', 'Math modeling']
+    survey.projects = [Project('Project %d' % i, i) for i in range(1, p+1)]
+    survey.unlocked_projects = survey.projects
+    survey.locked_projects = []
+
+    names = [('First%d' % i, 'Last%d' % i) for i in range(n)]
+
+    def other_name(i):
+        """a random name other than names[i]"""
+        j = rng.randrange(n - 1)
+        return ' '.join(names[j + (j >= i)])
+
+    def some_names(i, prob):
+        return [other_name(i) if rng.random() < prob else ''
+                for k in range(2)]
+
+    for i, (first, last) in enumerate(names):
+        prefs = [rng.choice([1, 2, 3, 3, 4, 5]) for proj in survey.projects]
+        prefs[rng.randrange(p)] = 5
+        prefs = dict(zip(survey.projects, prefs))
+        roles = [rng.choice(['Lead', 'Eng', 'Design']), '', '', '']
+        skills = [rng.choice('YN') for skill in survey.skills]
+
+        stu = Student('id%d' % i, prefs, roles, skills, 'e%d' % i,
+                      some_names(i, 0.4), '', 'ME', some_names(i, 0.3))
+        stu.set_name(last, first)
+        stu.gpa = round(rng.uniform(2.5, 4.0), 2)
+        stu.is_citizen = rng.random() < 0.8
+        survey.students[stu.name.lower()] = stu
+
+        for proj, pref in prefs.iteritems():
+            proj.add(stu, pref)
+
+    survey.projects[0].restricted = True
+    survey.process_conflicts()
+    survey.process_friends()
+    survey.bar_noncitizens()
+    return survey
+
+
+class Tracker(object):
+    """counts full evaluations (in this process and the ones it
+    starts) and records the best score so far"""
+
+    def __init__(self):
+        self.counter = multiprocessing.Value('l', 0)
+        self.start = time.time()
+        self.curve = []     # list of (seconds, evals, score)
+
+    @property
+    def evals(self):
+        return self.counter.value
+
+    def count(self, n):
+        """add n evaluations"""
+        with self.counter.get_lock():
+            self.counter.value += n
+
+    def progress(self, score):
+        """record score if it is the best so far"""
+        if not self.curve or score < self.curve[-1][2]:
+            self.curve.append((time.time() - self.start, self.evals, score))
+
+    def best_at(self, seconds):
+        """the best score found within seconds, or None"""
+        t = [score for elapsed, _, score in self.curve if elapsed <= seconds]
+        return t[-1] if t else None
+
+
+class QuietPool(process.ElitePool):
+    """an ElitePool that doesn't save its allocations"""
+
+    def flush(self, threshold=None):
+        pass
+
+
+class QuietOptimizer(process.Optimizer):
+    """an Optimizer that doesn't write checkpoints or save
+    allocations"""
+
+    def __init__(self, survey):
+        process.Optimizer.__init__(self, survey)
+        self.elite = QuietPool(survey)
+
+    def checkpoint(self, filename=None):
+        pass
+
+
+def run_optimizer(survey, budget, progress):
+    """take Optimizer steps, as optimize() does, for budget seconds"""
+    optimizer = QuietOptimizer(survey)
+    deadline = time.time() + budget
+    best = optimizer.best[0]
+    while time.time() < deadline:
+        done = optimizer.step()
+        if optimizer.best[0] < best:
+            best = optimizer.best[0]
+            progress(best)
+        if done:
+            break
+
+
+def run_islands(survey, budget, progress):
+    process.islands_search(survey, budget, progress=progress)
+
+
+def run_search(kick):
+    """make an engine that runs the generate-and-improve loop with
+    the given KICK"""
+    def engine(survey, budget, progress):
+        process.KICK = kick
+        process.search(survey, budget, progress)
+    return engine
+
+
+def run_genetic(survey, budget, progress):
+    process.evolve(survey, budget, progress)
+
+
+# map from engine name to a function that runs it on a survey for a
+# number of seconds, calling progress with each new best score
+ENGINES = {
+    'desperate': run_search('desperate'),
+    'lns': run_search('lns'),
+    'optimize': run_optimizer,
+    'islands': run_islands,
+}
+if process.np is not None:
+    ENGINES['genetic'] = run_genetic
+
+
+def run(name, seed, n, p, budget):
+    """run one engine on one survey; return its Tracker"""
+    tracker = Tracker()
+
+    # count every full evaluation, one-at-a-time or vectorized
+    evaluate = vars(process.Allocation)['evaluate']
+
+    def counted_evaluate(self, flag=False):
+        tracker.count(1)
+        return evaluate(self, flag)
+
+    process.Allocation.evaluate = counted_evaluate
+
+    if process.np is not None:
+        fitness = vars(process.Fitness)['__call__']
+
+        def counted_fitness(self, pop):
+            tracker.count(len(pop))
+            return fitness(self, pop)
+
+        process.Fitness.__call__ = counted_fitness
+
+    # the solvers talk a lot, and run_search changes KICK
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    kick = process.KICK
+    try:
+        survey = make_survey(seed, n, p)
+        random.seed(seed)
+        ENGINES[name](survey, budget, tracker.progress)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        process.KICK = kick
+        process.Allocation.evaluate = evaluate
+        if process.np is not None:
+            process.Fitness.__call__ = fitness
+    return tracker
+
+
+def main(script, budget=BUDGET, *names):
+    budget = float(budget)
+    names = names or sorted(ENGINES)
+    process.VERBOSE = False
+    checkpoints = [c for c in CHECKPOINTS if c < budget] + [budget]
+
+    writer = csv.writer(open(CURVEFILE, 'w'))
+    writer.writerow(['engine', 'seed', 'n', 'p', 'seconds', 'evals', 'score'])
+
+    print '\t'.join(['engine', 'evals'] + ['%gs' % c for c in checkpoints] +
+                    ['min', 'max'])
+    for name in names:
+        bests = []
+        evals = 0
+        for seed, n, p in SURVEYS:
+            t = run(name, seed, n, p, budget)
+            evals += t.evals
+            for row in t.curve:
+                writer.writerow([name, seed, n, p] + list(row))
+            bests.append([t.best_at(c) for c in checkpoints])
+
+        # mean over the surveys, where every run has found something
+        row = [name, evals / len(SURVEYS)]
+        for scores in zip(*bests):
+            if None in scores:
+                row.append('-')
+            else:
+                row.append('%.1f' % (sum(scores) / float(len(scores))))
+
+        # the range of the final scores
+        finals = [scores[-1] for scores in bests if scores[-1] is not None]
+        row += [min(finals), max(finals)] if finals else ['-', '-']
+        print '\t'.join(str(x) for x in row)
+
+
+if __name__ == '__main__':
+    main(*sys.argv)
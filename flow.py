@@ -0,0 +1,102 @@
+from collections import deque
+
+
+class MinCostFlow(object):
+    """Minimum-cost flow by successive shortest paths.
+
+    Nodes can be any hashable objects.  Edge costs may be negative
+    as long as there are no negative cycles.
+    """
+
+    def __init__(self):
+        self.adj = {}       # map from node to list of edge indices
+        self.head = []      # node each edge points to
+        self.cap = []       # residual capacity of each edge
+        self.cost = []      # cost per unit of flow on each edge
+
+    def add_node(self, u):
+        self.adj.setdefault(u, [])
+
+    def add_edge(self, u, v, cap, cost):
+        """add an edge from u to v and its residual twin
+
+        Edge i and its twin are i and i^1.  Returns i.
+        """
+        self.add_node(u)
+        self.add_node(v)
+        e = len(self.head)
+        self.adj[u].append(e)
+        self.head.append(v)
+        self.cap.append(cap)
+        self.cost.append(cost)
+
+        self.adj[v].append(len(self.head))
+        self.head.append(u)
+        self.cap.append(0)
+        self.cost.append(-cost)
+        return e
+
+    def flow(self, e):
+        """how much flow is on edge e"""
+        return self.cap[e ^ 1]
+
+    def shortest_paths(self, source):
+        """find the cheapest path from source to every reachable node
+        in the residual graph (Bellman-Ford with a queue).
+
+        Returns (dist, pred), where pred maps from a node to the edge
+        used to reach it.
+        """
+        dist = {source: 0}
+        pred = {}
+        queue = deque([source])
+        queued = set([source])
+
+        while queue:
+            u = queue.popleft()
+            queued.discard(u)
+            for e in self.adj[u]:
+                if self.cap[e] <= 0:
+                    continue
+                v = self.head[e]
+                d = dist[u] + self.cost[e]
+                if d < dist.get(v, d + 1):
+                    dist[v] = d
+                    pred[v] = e
+                    if v not in queued:
+                        queue.append(v)
+                        queued.add(v)
+        return dist, pred
+
+    def solve(self, source, sink, limit=float('Inf')):
+        """send as much flow as possible (but no more than limit)
+        from source to sink at minimum cost.
+
+        Returns (flow, cost).
+        """
+        flow = 0
+        total = 0
+        while flow < limit:
+            dist, pred = self.shortest_paths(source)
+            if sink not in dist:
+                break
+
+            # find the bottleneck along the path
+            push = limit - flow
+            v = sink
+            while v != source:
+                e = pred[v]
+                push = min(push, self.cap[e])
+                v = self.head[e ^ 1]
+
+            # push flow along the path
+            v = sink
+            while v != source:
+                e = pred[v]
+                self.cap[e] -= push
+                self.cap[e ^ 1] += push
+                v = self.head[e ^ 1]
+
+            flow += push
+            total += push * dist[sink]
+        return flow, total
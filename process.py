@@ -25,10 +25,46 @@ a2ps -B --borders=no -1 -o summary.ps summary; evince summary.ps
 
 python process.py
 
+If it gets interrupted, pick up from the last checkpoint with
+
+python process.py resume
+
+This can start before everyone has done the survey: whenever
+survey.csv changes, the new and changed responses are read and the
+students are absorbed into the current allocation.
+
+or, for a large cohort that spans several programs,
+
+python process.py decompose
+
+To compare the trade-offs of different cost weights, fill in
+WEIGHT_GRID and run
+
+python process.py sweep
+
+To run one search per CPU that share their best allocations now and
+then, run
+
+python process.py islands [budget] [number of islands]
+
+To compare the solvers on synthetic surveys (best score against time
+and number of evaluations), run
+
+python benchmark.py [budget] [engine ...]
+
 6) Remove duplicates
 
 python rmdupes.py
 
+and group the allocations that are minor variations of each other
+
+python process.py cluster *.pkl
+
+After changing the weights or constraints, re-rank the saved
+allocations (and print the best RESCORE_TOP of them) with
+
+python process.py rescore *.pkl
+
 7) To print selected allocations:
 
 python ./process.py 032*.pkl > allocs.txt
@@ -43,25 +79,111 @@ a2ps -1 -L100 -B --borders=no -o allocs.ps allocs.txt; evince allocs.ps
 
 python ./process.py 008.1441721038.212501.pkl > allocs.txt
 
-Edit in the trades and send to SCOPE director
+Edit in the trades and send to SCOPE director.  To check what a
+trade would cost (and make it) interactively, run
+
+python ./process.py whatif 008.1441721038.212501.pkl
 
 """
 
 #!/usr/bin/python
+import os
 import sys
+import signal
 import random
+import heapq
 import pickle
 import time
+import math
 import csv
+import itertools
+import multiprocessing
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from fuzzy import FuzzyDict
 from wrap import wrap
+from flow import MinCostFlow
 
 DUMP_SWAPS = False
 DUMP_FINAL = False
 
 WORTH_SAVING = 28
 
+# stop optimizing when the best score is within this much of the
+# lower bound
+OPTIMALITY_GAP = 0
+
+# the optimizer saves its state to CHECKPOINT_FILE this often (in
+# seconds); python process.py resume picks up from there
+CHECKPOINT_FILE = 'checkpoint.pkl'
+CHECKPOINT_INTERVAL = 60
+
+# the optimizer keeps the ELITE_SIZE best allocations that differ from
+# each other in at least ELITE_DISTANCE placements, and saves the ones
+# scoring WORTH_SAVING or better at each checkpoint
+ELITE_SIZE = 10
+ELITE_DISTANCE = 4
+
+# what the optimizer does when improvement stalls: 'desperate' moves
+# every unhappy student; 'lns' destroys and rebuilds LNS_TEAMS related
+# teams, LNS_ROUNDS times
+KICK = 'desperate'
+LNS_TEAMS = 3
+LNS_ROUNDS = 20
+
+# students re-inserted by LNS are placed exactly (by min-cost flow,
+# ignoring conflicts among themselves) when there are at most this
+# many, otherwise by the regret heuristic
+LNS_EXACT_LIMIT = 20
+
+# which rebuilt allocations LNS keeps: 'better', 'equal' (no worse),
+# 'threshold' (no more than LNS_THRESHOLD worse), or 'anneal' (worse
+# by delta with probability exp(-delta / LNS_TEMPERATURE))
+LNS_ACCEPT = 'equal'
+LNS_THRESHOLD = 5
+LNS_TEMPERATURE = 10.0
+
+# with SCHEDULE, the optimizer's fix_and_swap applies the OPERATORS
+# (methods of Allocation) in the order a bandit picks them: usually the
+# one with the best recent improvement per CPU second (a moving average
+# that gives the newest result weight OPERATOR_DECAY), but a random one
+# with probability OPERATOR_EPSILON.  It picks among the KICKS the same
+# way, instead of always using KICK.
+SCHEDULE = True
+OPERATORS = ['fix_conflicts', 'find_swaps', 'find_moves', 'fix_understaff',
+             'repartitions']
+KICKS = ['desperate', 'lns']
+OPERATOR_DECAY = 0.2
+OPERATOR_EPSILON = 0.1
+
+# when there are no more swaps, fix_and_swap re-partitions pairs of
+# teams exactly, pairing each of the REPARTITION_TEAMS most troubled
+# teams with every other team (and, with REPARTITION_TRIPLES, with the
+# two teams most related to it); each search gives up after
+# REPARTITION_NODES nodes
+REPARTITION = True
+REPARTITION_TEAMS = 3
+REPARTITION_TRIPLES = False
+REPARTITION_NODES = 20000
+
+# the optimizer remembers the signatures of the local optima it finds;
+# each time it lands on one again, it kicks one more time, and after
+# REVISIT_LIMIT revisits in a row it starts over
+REVISIT_LIMIT = 3
+
+# python process.py rescore re-scores saved allocations against the
+# current survey and weights and dumps the best RESCORE_TOP of them
+RESCORE_TOP = 5
+
+# python process.py cluster puts saved allocations in the same cluster
+# when they differ from its best member in at most this many placements
+CLUSTER_RADIUS = 6
+
 PROJECT_NAMES = [
     'Name 1',
     'Name 2',
@@ -104,6 +226,24 @@ BARRED_STUDENTS = [
 # TODO: implement locked and barred students without modifying
 # preferences
 
+# projects that should be allocated together when decomposing a
+# large cohort (python process.py decompose)
+PROJECT_GROUPS = [
+]
+
+# when decomposing, students are linked to the projects they rated
+# at least this high
+ELIGIBLE_PREF = 3
+
+# seconds spent on each part of a decomposed cohort
+DECOMPOSE_BUDGET = 60
+
+# parameters of the genetic solver (python process.py genetic)
+GENETIC_BUDGET = 600
+POPULATION_SIZE = 20
+IMPROVE_FRACTION = 0.25
+MUTATION_RATE = 0.02
+
 SURVEYFILE = 'survey.csv'
 STUDENTFILE = 'students.csv'
 
@@ -114,6 +254,47 @@ UNDERCOST = 100000
 GPACOST = 100
 NONCITIZENCOST = 1000
 
+# each teammate a student asks for (in the survey columns with
+# 'teammate' in the title) adds AFFINITYBONUS to the cost if they
+# don't end up on the same team; a pair who ask for each other pay
+# it twice
+AFFINITYBONUS = 3
+
+# map from team size to maximum number of low GPAs
+GPA_LIMITS = {4:2, 5:2, 6:3, 7:3, 8:3}
+
+# minimum number of students on each team with a skill (named as in
+# the skills columns of the survey) or a first-choice role, and the
+# cost of each student missing from a minimum; for example, to put at
+# least one programmer on each team, use
+# SKILL_MINIMUMS = {'Programming': 1}
+SKILL_MINIMUMS = {
+}
+ROLE_MINIMUMS = {
+}
+COVERAGECOST = 10
+
+# cost weights to try in python process.py sweep: each name maps to
+# a list of values, and every combination is run for SWEEP_BUDGET
+# seconds in a separate process
+WEIGHT_GRID = {
+    'CONFLICTCOST': [50, 100, 200],
+    'GPACOST': [100, 1000],
+}
+SWEEP_BUDGET = 300
+
+# python process.py islands runs ISLANDS searches (by default, one per
+# CPU) of ISLAND_SIZE allocations each for ISLAND_BUDGET seconds; every
+# MIGRATION_INTERVAL seconds, each island sends its best allocation to
+# the next one around the ring, which replaces its worst member with it
+ISLANDS = None
+ISLAND_SIZE = 4
+ISLAND_BUDGET = 600
+MIGRATION_INTERVAL = 30
+
+# print the score every time it's computed
+VERBOSE = True
+
 SKILL_NAMES = [
     'Machine Shop',
     'Mechanical Design',
@@ -154,12 +335,61 @@ class Hist(dict):
         self[x] = self.get(x, 0) + 1
 
 
+# the Zobrist keys, one random 64-bit number per (stuid, proj.i),
+# seeded by the pair so they agree across runs and processes
+zobrist_keys = {}
+
+# the signatures of the allocations pickled by this process
+saved_signatures = set()
+
+
+def zobrist(stuid, i):
+    """the Zobrist key for the student with stuid on project i"""
+    key = zobrist_keys.get((stuid, i))
+    if key is None:
+        key = random.Random('%s %d' % (stuid, i)).getrandbits(64)
+        zobrist_keys[stuid, i] = key
+    return key
+
+
+def placement_signature(stuids, placement):
+    """the Zobrist hash of a placement (see ElitePool), which is the
+    signature of the allocation it came from; students who are not
+    placed (0) don't count"""
+    signature = 0
+    for stuid, i in zip(stuids, placement):
+        if i:
+            signature ^= zobrist(stuid, i)
+    return signature
+
+
 class Allocation:
     """an allocation represents an assignment of students to
     teams
 
     teams: map from Project to a list of students
     ison: maps from a student to the team s/he is on
+    pos: maps from a student to his/her index in teams[ison[stu]]
+    ranked: maps from a student to the list of projects in
+            decreasing order of preference
+    cands: maps from (src, dest) to an Mdict that maps from a
+           preference to the set of students on src who gave dest
+           that preference
+    minimums: list of the minimums in SKILL_MINIMUMS and ROLE_MINIMUMS
+    features: maps from a student to the indices of the minimums
+              s/he counts toward
+    covered: maps from a project to a list of the number of students
+             on the team who count toward each minimum
+    signature: Zobrist hash of the placements, the XOR of
+               zobrist(stu.stuid, proj.i) for each student on a team
+    bonus: maps from a project to the total affinity between pairs
+           of students on the team
+    wanted: the total affinity between pairs of students in the
+            allocation, which is what bonus adds up to when every
+            request is met
+    journal: list of the adds and removes since the outermost begin,
+             or None outside a transaction
+    marks: list of the length of the journal at each open begin
     projects: list of Project
     skills: list of string skill names
     students: list of Student
@@ -171,6 +401,8 @@ class Allocation:
         self.projects = survey.projects
         self.skills = survey.skills
         self.conflicts = None
+        self.journal = None
+        self.marks = []
 
         t = [(stu.last, stu.first, stu) for stu in survey.students.values()]
         t.sort()
@@ -179,17 +411,228 @@ class Allocation:
         for proj in self.projects:
             self.teams[proj] = []
 
+        self.reindex()
+
+    # the attributes that reindex can rebuild from teams and ison
+    DERIVED = ['skill_minimums', 'role_minimums', 'minimums', 'ranked',
+               'features', 'pos', 'cands', 'covered', 'signature',
+               'bonus', 'wanted', 'journal', 'marks']
+
+    def __getstate__(self):
+        """pickle only the teams; the indices are rebuilt on loading"""
+        state = self.__dict__.copy()
+        for name in self.DERIVED:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        """rebuild the indices when loading allocations that were
+        pickled without them"""
+        self.__dict__.update(state)
+        if 'wanted' not in state:
+            self.reindex()
+        if 'journal' not in state:
+            self.journal = None
+            self.marks = []
+
+    def reindex(self):
+        """build the ranked project lists and the indices of the
+        current teams from scratch"""
+        self.skill_minimums = [(self.skills.index(name), n)
+                               for name, n in
+                               sorted(SKILL_MINIMUMS.iteritems())
+                               if name in self.skills]
+        self.role_minimums = sorted(ROLE_MINIMUMS.iteritems())
+        self.minimums = [n for _, n in
+                         self.skill_minimums + self.role_minimums]
+
+        self.ranked = {}
+        self.features = {}
+        for stu in self.students:
+            self.index_student(stu)
+
+        self.pos = {}
+        self.cands = {}
+        self.covered = {}
+        self.signature = 0
+        for src in self.projects:
+            self.covered[src] = [0] * len(self.minimums)
+            for dest in self.projects:
+                if src is not dest:
+                    self.cands[src, dest] = {}
+
+        for proj, team in self.teams.iteritems():
+            for i, stu in enumerate(team):
+                self.pos[stu] = i
+                self.index_candidate(stu, proj)
+                for j in self.features[stu]:
+                    self.covered[proj][j] += 1
+                self.signature ^= zobrist(stu.stuid, proj.i)
+
+        self.bonus = {}
+        for proj in self.projects:
+            self.bonus[proj] = self.team_bonus(proj)
+        self.wanted = self.total_affinity()
+
+    def total_affinity(self):
+        """compute the total affinity between pairs of students in
+        the allocation, wherever they are"""
+        present = set(self.students)
+        return sum(w for stu in self.students
+                   for stu2, w in stu.affinity.iteritems()
+                   if stu2 in present) // 2
+
+    def team_bonus(self, proj):
+        """compute the total affinity on proj from scratch"""
+        return sum(self.affinity(stu, proj) for stu in self.teams[proj]) // 2
+
+    def affinity(self, stu, proj, exclude=None):
+        """the total affinity between stu and the members of proj
+        other than exclude"""
+        return sum(w for stu2, w in stu.affinity.iteritems()
+                   if stu2 is not exclude and self.ison.get(stu2) is proj)
+
+    def index_student(self, stu):
+        """compute the ranked project list and the features of stu"""
+        t = [(stu.prefs[proj], random.random(), proj)
+             for proj in self.projects]
+        t.sort(reverse=True)
+        self.ranked[stu] = [proj for _, _, proj in t]
+
+        has = ([stu.skills[i] == 'Y' for i, _ in self.skill_minimums] +
+               [stu.roles[0] == role for role, _ in self.role_minimums])
+        self.features[stu] = [j for j, flag in enumerate(has) if flag]
+
+    def absorb(self, stus):
+        """bring this allocation up to date after the survey added or
+        changed stus.  Changed students stay where they are but are
+        re-indexed under their new responses; new students go on the
+        cheapest project with room.  Nobody else is touched."""
+        new = []
+        for stu in stus:
+            proj = self.ison.get(stu)
+            if proj is None:
+                self.index_student(stu)
+                new.append(stu)
+                continue
+
+            # the old prefs are gone, so search every bucket
+            for dest in self.projects:
+                if dest is not proj:
+                    for bucket in self.cands[proj, dest].itervalues():
+                        bucket.discard(stu)
+            covered = self.covered[proj]
+            for j in self.features[stu]:
+                covered[j] -= 1
+
+            self.index_student(stu)
+            self.index_candidate(stu, proj)
+            for j in self.features[stu]:
+                covered[j] += 1
+
+        if new:
+            t = [(stu.last, stu.first, stu) for stu in self.students + new]
+            t.sort()
+            self.students = [stu for (_, _, stu) in t]
+
+            neighbors = conflict_graph(self.students)
+            for stu in new:
+                _, _, proj = min(placement_costs(self, stu, neighbors))
+                self.add(stu, proj)
+
+        # the changed students' affinities may have changed too
+        for proj in self.projects:
+            self.bonus[proj] = self.team_bonus(proj)
+        self.wanted = self.total_affinity()
+
+    def index_candidate(self, stu, src):
+        """add stu to the candidate buckets for src"""
+        for dest in self.projects:
+            if dest is not src:
+                bucket = self.cands[src, dest]
+                bucket.setdefault(stu.prefs[dest], set()).add(stu)
+
+    def unindex_candidate(self, stu, src):
+        """remove stu from the candidate buckets for src"""
+        for dest in self.projects:
+            if dest is not src:
+                self.cands[src, dest][stu.prefs[dest]].discard(stu)
+
     def add(self, stu, proj):
         """add stu to proj"""
         assert self.ison.get(stu, None) == None
-        self.teams[proj].append(stu)
+        team = self.teams[proj]
+        self.pos[stu] = len(team)
+        team.append(stu)
         self.ison[stu] = proj
+        self.index_candidate(stu, proj)
+        covered = self.covered[proj]
+        for j in self.features[stu]:
+            covered[j] += 1
+        self.signature ^= zobrist(stu.stuid, proj.i)
+        self.bonus[proj] += self.affinity(stu, proj)
+        if self.journal is not None:
+            self.journal.append((stu, proj, None))
 
     def remove(self, stu, proj):
-        """remove stu from proj"""
+        """remove stu from proj by moving the last member of the
+        team into the vacated slot"""
         assert self.ison[stu] == proj
-        self.teams[proj].remove(stu)
+        team = self.teams[proj]
+        i = self.pos.pop(stu)
+        last = team.pop()
+        if last is not stu:
+            team[i] = last
+            self.pos[last] = i
         self.ison[stu] = None
+        self.unindex_candidate(stu, proj)
+        covered = self.covered[proj]
+        for j in self.features[stu]:
+            covered[j] -= 1
+        self.signature ^= zobrist(stu.stuid, proj.i)
+        self.bonus[proj] -= self.affinity(stu, proj)
+        if self.journal is not None:
+            self.journal.append((stu, proj, i))
+
+    def begin(self):
+        """start a transaction: the adds and removes (and so the
+        moves and swaps) from here on can be undone by rollback.
+        Transactions can be nested."""
+        if self.journal is None:
+            self.journal = []
+        self.marks.append(len(self.journal))
+
+    def commit(self):
+        """keep the changes made since the matching begin"""
+        self.marks.pop()
+        if not self.marks:
+            self.journal = None
+
+    def rollback(self):
+        """undo the changes made since the matching begin, in time
+        proportional to the number of them; teams come back in the
+        same order, along with all of the indices"""
+        mark = self.marks.pop()
+        journal, self.journal = self.journal, None
+        while len(journal) > mark:
+            stu, proj, i = journal.pop()
+            if i is None:
+                # stu was added at the end of the team
+                self.remove(stu, proj)
+            else:
+                # stu was at i, and the last member took its place
+                self.add(stu, proj)
+                team = self.teams[proj]
+                if team[i] is not stu:
+                    last = team[i]
+                    team[i], team[-1] = stu, last
+                    self.pos[stu], self.pos[last] = i, len(team) - 1
+        if self.marks:
+            self.journal = journal
+
+    def on(self, stu, proj):
+        """is stu on proj?"""
+        return self.ison.get(stu) is proj
 
     def num(self, proj):
         """return the number of students on proj"""
@@ -232,58 +675,73 @@ class Allocation:
 
     def dump_swaps(self):
         """for each student, print the cheapest swaps and moves"""
+        index = TradeIndex(self)
         for stu in self.students:
-            print stu, self.ison[stu]
-
-            swaps = self.cheapest_swaps(stu)
-            for cost, stu2 in swaps:
-                proj = self.ison[stu2]
-                print '    %d\t%20.20s %8.8s  %s %s' % (cost, stu2,
-                                               stu2.major, stu2.gpa,
-                                               str(proj)[:30])
-
-            print ''
-            moves = self.cheapest_moves(stu)
-            for cost, proj in moves:
-                print '    %d\t%s' % (cost, str(proj)[:30])
-
-            print ''
+            index.dump_options(stu)
 
     def pickle(self):
         """save this allocation in a pickle file with name
-        score.timestamp.pkl"""
-        self.note_conflicts()
+        score.timestamp.pkl, unless an identical one was saved
+        already.  The file holds the sorted (stuid, proj.i) pairs of
+        the assignment, not the Students and Projects, so its size
+        and the depth of the pickler's recursion don't grow with the
+        survey; load_alloc rebuilds it."""
+        if self.signature in saved_signatures:
+            return
+        saved_signatures.add(self.signature)
         score = self.score()
         ts = time.time()
         filename = '%.3d.%.6f.pkl' % (score, ts)
         fp = open(filename, 'wb')
-        pickle.dump(self, fp)
+        pickle.dump(sorted(self.assignment().iteritems()), fp,
+                    pickle.HIGHEST_PROTOCOL)
+        fp.close()
+
+    def snapshot(self):
+        """return an array with the position in self.projects of each
+        student's project (-1 if none), in the order of self.students"""
+        index = dict((proj, j) for j, proj in enumerate(self.projects))
+        return array('h', [index.get(self.ison.get(stu), -1)
+                           for stu in self.students])
+
+    def restore(self, snap):
+        """put the students back where they were when snap was taken
+        (by this allocation or another of the same survey), moving
+        only the ones who are somewhere else"""
+        moved = []
+        for stu, j in zip(self.students, snap):
+            src = self.ison.get(stu)
+            dest = self.projects[j] if j >= 0 else None
+            if src is not dest:
+                if src:
+                    self.remove(stu, src)
+                moved.append((stu, dest))
+        for stu, dest in moved:
+            if dest:
+                self.add(stu, dest)
+
+    def assignment(self):
+        """return a map from student id to project index (proj.i)"""
+        return dict((stu.stuid, proj.i)
+                    for stu, proj in self.ison.iteritems() if proj)
 
     def score(self, flag=False):
         """compute the score for this allocation, printing only
         if flag is true"""
+        total, scores, conflicts = self.evaluate(flag)
+        if VERBOSE:
+            print scores, '+', conflicts, 'conflicts =', total
+        return total
 
-        def enough_on_list(proj, name_list, minimum):
-            """Checks whether a team has no E:C"""
-            count = 0
-            for stu in self.teams[proj]:
-                if stu.name in name_list:
-                    count += 1
-            return count >= minimum
+    def evaluate(self, flag=False):
+        """compute the score for this allocation without printing a
+        summary; return (score, Hist of preferences, conflicts)"""
 
         scores = Hist()
         total = 0
-
-        # map from team size to maximum number of low GPAs
-        limit = {4:2, 5:2, 6:3, 7:3, 8:3}
+        limit = GPA_LIMITS
 
         for proj, stus in self.teams.iteritems():
-            # use this to make sure a team gets enough people
-            # from a particular list
-            #if proj.name == 'Name 1':
-            #    if not enough_on_list(proj, SPECIAL_LIST, 2):
-            #        total += 100
-
             # if a project is under or overstaffed, that's bad
             if self.num(proj) < proj.minstaff:
                 total += UNDERCOST
@@ -314,6 +772,13 @@ class Allocation:
             except KeyError:
                 pass
 
+            # check for missing skills and roles
+            shortfall = self.shortfall(proj)
+            if shortfall:
+                total += shortfall * COVERAGECOST
+                if flag:
+                    print 'Missing skills or roles:', proj.name
+
         # total up the placement scores
         for pref, num in scores.iteritems():
             total += num * PREFCOST[pref]
@@ -322,8 +787,69 @@ class Allocation:
         conflicts = self.total_conflicts()
         total += conflicts * CONFLICTCOST
 
-        print scores, '+', conflicts, 'conflicts =', total
-        return total
+        # and a penalty for the teammates who didn't get their wish
+        total += self.unmet()
+        return total, scores, conflicts
+
+    def breakdown(self):
+        """return a Hist that counts the students at each preference
+        and the number of conflicts, GPA violations, students missing
+        from the skill and role minimums, non-citizens on restricted
+        projects, and under- and overstaffed projects, and the total
+        affinity of the teammate requests that were not met"""
+        counts = Hist()
+        for proj, stus in self.teams.iteritems():
+            for stu in stus:
+                counts.count(stu.prefs[proj])
+                if proj.restricted and not stu.is_citizen:
+                    counts.count('noncitizens')
+
+            if self.num(proj) < proj.minstaff:
+                counts.count('under')
+            if self.num(proj) > proj.maxstaff:
+                counts.count('over')
+
+            gpas = [stu.gpa for stu in stus if float(stu.gpa) < 3.0]
+            if len(gpas) > GPA_LIMITS.get(len(stus), len(stus)):
+                counts.count('gpa')
+
+            shortfall = self.shortfall(proj)
+            if shortfall:
+                counts['coverage'] = counts.get('coverage', 0) + shortfall
+
+        counts['conflicts'] = self.total_conflicts()
+        unmet = self.unmet()
+        if unmet:
+            counts['unmet'] = unmet
+        return counts
+
+    def unmet(self):
+        """the total affinity between pairs of students who are not
+        on the same team"""
+        return self.wanted - sum(self.bonus.itervalues())
+
+    def shortfall(self, proj):
+        """how many students is proj missing from the skill and role
+        minimums?"""
+        return sum(max(n - count, 0)
+                   for n, count in zip(self.minimums, self.covered[proj]))
+
+    def cost_coverage(self, proj, out=None, inn=None):
+        """what is the net change in coverage cost for proj if out
+        leaves the team and inn joins it"""
+        covered = self.covered[proj]
+        minimums = self.minimums
+        lost = self.features[out] if out else []
+        gained = self.features[inn] if inn else []
+
+        total = 0
+        for j in lost:
+            if j not in gained and covered[j] <= minimums[j]:
+                total += 1
+        for j in gained:
+            if j not in lost and covered[j] < minimums[j]:
+                total -= 1
+        return total * COVERAGECOST
 
     def total_conflicts(self):
         """how many conflicts are there in the whole allocation?"""
@@ -332,7 +858,7 @@ class Allocation:
             team = self.teams[proj]
             for stu in team:
                 for anti in stu.antistus:
-                    if anti in team:
+                    if self.on(anti, proj):
                         count += 1
         return count
 
@@ -345,7 +871,7 @@ class Allocation:
             team = self.teams[proj]
             for stu in team:
                 for anti in stu.antistus:
-                    if anti in team:
+                    if self.on(anti, proj):
                         self.conflicts[stu] = anti
 
     def fix_conflicts(self):
@@ -357,7 +883,7 @@ class Allocation:
             team = self.teams[proj]
             for stu in team:
                 for anti in stu.antistus:
-                    if anti in team:
+                    if self.on(anti, proj):
                         stus.append(stu)
                         break
 
@@ -370,7 +896,9 @@ class Allocation:
 
     def fix_understaff(self):
         """check for projects that are understaffed and move
-        students if necessary
+        students if necessary.  If there aren't enough students to
+        go around (as in a partial survey), stop when no project can
+        spare one and leave the rest to UNDERCOST.
         """
         while True:
             # make a list of understaffed projects
@@ -381,10 +909,12 @@ class Allocation:
             random.shuffle(projects)
 
             for dest in projects:
-                self.add_student(dest)
+                if not self.add_student(dest):
+                    return
 
     def add_student(self, dest):
-        """move a student from another project to dest"""
+        """move a student from another project to dest; return False
+        if no project can spare one"""
         sources = [src for src in self.projects
                    if self.num(src) > src.minstaff and src is not dest]
 
@@ -399,61 +929,120 @@ class Allocation:
         # stus is the list of students that can move from src
         # to dest, decorated with preference and a random number
 
+        if not stus:
+            return False
         _, _, stu = max(stus)
         self.move(stu, dest)
+        return True
+
+    def fix_and_swap(self, visited=(), scheduler=None, deadline=None):
+        """start by fixing conflicts and then look for swaps (and
+        when there are none, repartitions); repeat 10 times or until
+        there are no more moves, or until the allocation is one of
+        the local optima whose signatures are in visited, or until
+        time.time() passes deadline (if given).
+
+        If scheduler is given, let it choose the operators instead.
+        """
+        if scheduler is not None:
+            return self.scheduled_search(scheduler, visited, deadline)
 
-    def fix_and_swap(self):
-        """start by fixing conflicts and then look for swaps;
-        repeat 10 times or until there are no more moves"""
         for _ in range(10):
+            if self.signature in visited or past(deadline):
+                return
             self.score()
             swaps = 0
             swaps += self.fix_conflicts()
-            swaps += self.find_swaps()
+            swaps += self.find_swaps(deadline)
+            if swaps == 0 and REPARTITION and not past(deadline):
+                swaps += self.repartitions()
             # print 'made %d swaps\n' % swaps,
             if swaps == 0:
                 break
 
-    def find_swaps(self):
-        """find all the students who are sad and try to find
-        a swap that makes them happy.  Return the total number
-        of swaps made.
-	"""
-	# make a list of (diff, random, student) tuples, in ascending order
+    def scheduled_search(self, scheduler, visited=(), deadline=None):
+        """apply the operators scheduler chooses until none of them
+        improves the score, or until the allocation is one of the
+        local optima whose signatures are in visited, or until
+        time.time() passes deadline (if given)"""
+        score = self.evaluate()[0]
+
+        # stalled is the set of operators that have not helped since
+        # the last improvement
+        stalled = set()
+        while len(stalled) < len(scheduler.names):
+            if self.signature in visited or past(deadline):
+                return
+            name = scheduler.choose(stalled)
+            start = time.clock()
+            getattr(self, name)()
+            after = self.evaluate()[0]
+            scheduler.record(name, score - after, time.clock() - start)
+
+            if after < score:
+                stalled = set()
+            else:
+                stalled.add(name)
+            score = after
+        self.score()
+
+    def sad_students(self):
+        """return the students in increasing order of how happy they
+        are compared to their favorite project"""
+        # make a list of (diff, random, student) tuples, in ascending order
         sad = [(stu.prefs[self.ison[stu]]-stu.maxpref, random.random(), stu)
                for stu in self.students]
         sad.sort()
+        return [stu for _, _, stu in sad]
 
+    def find_swaps(self, deadline=None):
+        """find all the students who are sad and try to find
+        a swap that makes them happy, stopping early if time.time()
+        passes deadline (if given).  Return the total number of
+        swaps made.
+        """
         # try to make each student happier without hurting the global score
         total = 0
-        for _, _, stu in sad:
+        for stu in self.sad_students():
+            if past(deadline):
+                break
             total += self.find_swap(stu) or self.find_move(stu)
         return total
 
+    def find_moves(self):
+        """like find_swaps, but only try to move each student"""
+        total = 0
+        for stu in self.sad_students():
+            total += self.find_move(stu)
+        return total
+
     def find_swap(self, stu, tol=0):
         """find the first swap that makes this student happier
         and that hurts the score by no more than tol (as tol
         gets large and negative, we accept more moves)
         """
         src = self.ison[stu]
-        t = []
+
+        # make a heap of (-total, random, dest, pref) tuples, one for
+        # each bucket of students on dest who gave src the same pref
+        heap = []
         for dest in self.projects:
             if src is dest: continue
-            for stu2 in self.teams[dest]:
-                total = stu2.prefs[src] + stu.prefs[dest]
-                rand = random.random()
-                t.append((total, rand, stu2))
-
-        if len(t) == 0:
-            return 0
-        t.sort(reverse=True)
-
-	# try out the possible swaps in decreasing order of total
-        # happiness
-
-        for total, rand, stu2 in t:
-            if self.try_swap(stu, stu2):
-                return 1
+            for pref, bucket in self.cands[dest, src].iteritems():
+                if bucket:
+                    total = pref + stu.prefs[dest]
+                    heap.append((-total, random.random(), dest, pref))
+        heapq.heapify(heap)
+
+        # try out the possible swaps in decreasing order of total
+        # happiness, shuffling only the buckets we get to
+        while heap:
+            _, _, dest, pref = heapq.heappop(heap)
+            stus = list(self.cands[dest, src][pref])
+            random.shuffle(stus)
+            for stu2 in stus:
+                if self.try_swap(stu, stu2):
+                    return 1
 
         return 0
 
@@ -461,15 +1050,10 @@ class Allocation:
         """find a project we can move this student to without
         hurting the global score by more than tol
         """
-	# find all the projects this student likes better
+        # try the projects in decreasing order of preference
         src = self.ison[stu]
-        pref = stu.prefs[src]
-        projects = [(stu.prefs[proj], proj)
-                    for proj in self.projects
-                    if proj != src]
-
-	# projects is a list of (preference, project) tuples
-        for pref, dest in projects:
+        for dest in self.ranked[stu]:
+            if dest is src: continue
             if self.try_move(stu, dest):
                 return 1
 
@@ -536,13 +1120,14 @@ class Allocation:
         given that (exclude) is _not_ on the project"""
         team = self.teams[proj]
         conflicts = [1 for stu2 in stu.antistus
-                     if stu2 is not exclude and stu2 in team]
+                     if stu2 is not exclude and self.on(stu2, proj)]
 
         conflicts += [1 for stu2 in team
                       if stu2 is not exclude and stu in stu2.antistus]
 
         pref = stu.prefs[proj]
         total = PREFCOST[pref] + CONFLICTCOST * len(conflicts)
+        total -= self.affinity(stu, proj, exclude)
         return total
 
     def cost_swap(self, stu1, stu2):
@@ -553,6 +1138,10 @@ class Allocation:
         after_cost = (self.cost(stu1, proj2, stu2) +
                       self.cost(stu2, proj1, stu1))
 
+        if proj1 is not proj2:
+            after_cost += (self.cost_coverage(proj1, stu1, stu2) +
+                           self.cost_coverage(proj2, stu2, stu1))
+
         return after_cost - before_cost
 
     def try_swap(self, stu1, stu2):
@@ -569,14 +1158,20 @@ class Allocation:
         """what is the net change in cost of moving stu to dest"""
         src = self.ison[stu]
         before_cost = self.cost(stu, src)
-        if self.num(src) == src.maxstaff+1: before_cost += OVERCOST
-        if self.num(src) == src.minstaff: before_cost -= UNDERCOST
-
         after_cost = self.cost(stu, dest)
-        if self.num(dest) == dest.maxstaff: after_cost += OVERCOST
-        if self.num(dest) == dest.minstaff-1: after_cost -= UNDERCOST
+        return (after_cost - before_cost + self.cost_staffing(src, dest) +
+                self.cost_coverage(src, out=stu) +
+                self.cost_coverage(dest, inn=stu))
 
-        return after_cost - before_cost
+    def cost_staffing(self, src, dest):
+        """what is the net change in staffing penalties of moving
+        a student from src to dest"""
+        total = 0
+        if self.num(src) == src.maxstaff+1: total -= OVERCOST
+        if self.num(src) == src.minstaff: total += UNDERCOST
+        if self.num(dest) == dest.maxstaff: total += OVERCOST
+        if self.num(dest) == dest.minstaff-1: total -= UNDERCOST
+        return total
 
     def try_move(self, stu, dest):
         """check the cost of moving stu to dest; if it's a win, do it"""
@@ -634,6 +1229,344 @@ class Allocation:
         else:
             self.swap(stu, stu2)
 
+    def related_teams(self, k):
+        """choose k teams worth rebuilding together: the team of a
+        random student who is unhappy or in conflict, and the teams
+        its members would rather be on or whose members they named"""
+        troubled = [stu for stu in self.students
+                    if stu.prefs[self.ison[stu]] < stu.maxpref or
+                    any(self.on(anti, self.ison[stu])
+                        for anti in stu.antistus)]
+        if not troubled:
+            troubled = self.students
+        seed = self.ison[random.choice(troubled)]
+        return self.related_to(seed, k)
+
+    def related_to(self, seed, k):
+        """return seed and the k-1 teams its members would rather be
+        on or whose members they named, most links first"""
+        links = Hist()
+        for stu in self.teams[seed]:
+            pref = stu.prefs[seed]
+            for proj in self.ranked[stu]:
+                if stu.prefs[proj] <= pref:
+                    break
+                links.count(proj)
+            for anti in stu.antistus:
+                links.count(self.ison.get(anti))
+
+        t = [(links.get(proj, 0), random.random(), proj)
+             for proj in self.projects if proj is not seed]
+        t.sort(reverse=True)
+        return [seed] + [proj for _, _, proj in t[:k-1]]
+
+    def trouble(self, proj):
+        """how far the members of proj are from their favorite
+        projects, plus the number of conflicts on the team"""
+        total = 0
+        for stu in self.teams[proj]:
+            total += stu.maxpref - stu.prefs[proj]
+            for anti in stu.antistus:
+                if self.on(anti, proj):
+                    total += 1
+        return total
+
+    def repartitions(self):
+        """try repartition on every pair of teams that includes one
+        of the REPARTITION_TEAMS most troubled teams (and, if
+        REPARTITION_TRIPLES, on each of those with the two teams most
+        related to it); return the number of improvements"""
+        t = [(self.trouble(proj), random.random(), proj)
+             for proj in self.projects]
+        t.sort(reverse=True)
+
+        total = 0
+        for trouble, _, proj in t[:REPARTITION_TEAMS]:
+            if trouble == 0:
+                break
+            for other in self.projects:
+                if other is not proj:
+                    total += self.repartition([proj, other])
+            if REPARTITION_TRIPLES:
+                total += self.repartition(self.related_to(proj, 3))
+        return total
+
+    def repartition(self, projects):
+        """find the best split of the members of projects (two or
+        three teams) among them by branch and bound, and make it if it
+        beats the current split.  Return 1 if it did, 0 otherwise.
+
+        Splits must respect minstaff, maxstaff and the restrictions;
+        they are scored on preferences, conflicts, GPA limits, and
+        skill and role coverage.  The search gives up after
+        REPARTITION_NODES nodes.
+        """
+        k = len(projects)
+        stus = [stu for proj in projects for stu in self.teams[proj]]
+        n = len(stus)
+        index = dict((stu, i) for i, stu in enumerate(stus))
+
+        # conflicts[i] maps from j to the cost of i and j together,
+        # which is negative if their affinity outweighs any conflict
+        conflicts = [Hist() for stu in stus]
+        for i, stu in enumerate(stus):
+            for anti in stu.antistus:
+                j = index.get(anti)
+                if j is not None:
+                    conflicts[i][j] = conflicts[i].get(j, 0) + CONFLICTCOST
+                    conflicts[j][i] = conflicts[j].get(i, 0) + CONFLICTCOST
+            for stu2, w in stu.affinity.iteritems():
+                j = index.get(stu2)
+                if j is not None:
+                    conflicts[i][j] = conflicts[i].get(j, 0) - w
+
+        # cost[i][p] is the cost of stu i on projects[p], or None if
+        # the student isn't allowed there
+        cost = [[None if proj.restricted and not stu.is_citizen
+                 else PREFCOST[stu.prefs[proj]] for proj in projects]
+                for stu in stus]
+        low = [float(stu.gpa) < 3.0 for stu in stus]
+        features = [self.features[stu] for stu in stus]
+        mins = [proj.minstaff for proj in projects]
+        maxs = [proj.maxstaff for proj in projects]
+
+        def extra(assign):
+            """the costs that only make sense for complete splits"""
+            total = 0
+            for p in range(k):
+                members = [i for i in range(n) if assign[i] == p]
+                size = len(members)
+                if size < mins[p]: total += UNDERCOST
+                if size > maxs[p]: total += OVERCOST
+                if sum(low[i] for i in members) > GPA_LIMITS.get(size, size):
+                    total += GPACOST
+                covered = [0] * len(self.minimums)
+                for i in members:
+                    for j in features[i]:
+                        covered[j] += 1
+                total += COVERAGECOST * sum(max(m - c, 0) for m, c in
+                                            zip(self.minimums, covered))
+            return total
+
+        def split_cost(assign):
+            """the cost of a complete split, allowed or not"""
+            total = extra(assign)
+            for i, p in enumerate(assign):
+                stu, proj = stus[i], projects[p]
+                total += PREFCOST[stu.prefs[proj]]
+                if proj.restricted and not stu.is_citizen:
+                    total += NONCITIZENCOST
+                total += sum(c for j, c in conflicts[i].iteritems()
+                             if j < i and assign[j] == p)
+            return total
+
+        current = [projects.index(self.ison[stu]) for stu in stus]
+        best = [split_cost(current), None]
+
+        # place the students with the most conflicts first, so the
+        # partial costs grow quickly; rest[d] is a lower bound on the
+        # cost of the students from depth d on, assuming each gets
+        # every bonus with the students placed before
+        order = sorted(range(n), key=lambda i: -len(conflicts[i]))
+        depth = dict((i, d) for d, i in enumerate(order))
+        rest = [0] * (n+1)
+        for d in range(n-1, -1, -1):
+            i = order[d]
+            options = [c for c in cost[i] if c is not None]
+            bonus = sum(min(c, 0) for j, c in conflicts[i].iteritems()
+                        if depth[j] < d)
+            rest[d] = rest[d+1] + (min(options) if options else 0) + bonus
+
+        assign = [None] * n
+        count = [0] * k
+        nodes = [0]
+
+        def search(d, partial):
+            nodes[0] += 1
+            if nodes[0] > REPARTITION_NODES:
+                return
+            if partial + rest[d] >= best[0]:
+                return
+            if sum(max(m - c, 0) for m, c in zip(mins, count)) > n - d:
+                return
+            if d == n:
+                total = partial + extra(assign)
+                if total < best[0]:
+                    best[:] = [total, list(assign)]
+                return
+
+            i = order[d]
+            t = [(c, p) for p, c in enumerate(cost[i])
+                 if c is not None and count[p] < maxs[p]]
+            t.sort()
+            for c, p in t:
+                c += sum(cc for j, cc in conflicts[i].iteritems()
+                         if assign[j] == p)
+                assign[i] = p
+                count[p] += 1
+                search(d+1, partial + c)
+                count[p] -= 1
+                assign[i] = None
+
+        search(0, 0)
+        if best[1] is None:
+            return 0
+
+        for stu in stus:
+            self.remove(stu, self.ison[stu])
+        for stu, p in zip(stus, best[1]):
+            self.add(stu, projects[p])
+        return 1
+
+    def lns(self):
+        """destroy LNS_TEAMS related teams and rebuild them.  Keep the
+        result if lns_accepts the change in score, otherwise put
+        everybody back.  Return True if the change was kept."""
+        projects = self.related_teams(LNS_TEAMS)
+        before = self.evaluate()[0]
+        self.begin()
+
+        removed = [(stu, proj) for proj in projects
+                   for stu in self.teams[proj]]
+        for stu, proj in removed:
+            self.remove(stu, proj)
+
+        stus = [stu for stu, _ in removed]
+        if len(stus) <= LNS_EXACT_LIMIT:
+            _, _, assignment = staffing_flow(stus, projects)
+            for stu, proj in assignment.iteritems():
+                self.add(stu, proj)
+            stus = [stu for stu in stus if stu not in assignment]
+        regret_insert(self, stus, projects)
+
+        if lns_accepts(self.evaluate()[0] - before):
+            self.commit()
+            return True
+
+        self.rollback()
+        return False
+
+
+
+class TradeIndex(object):
+    """answers what-if questions about trades in an allocation.
+
+    costs maps from (student, project) to alloc.cost(student, project),
+    so the cost of any move or swap can be computed in constant time.
+    When a trade is applied, only the entries of the conflict and
+    affinity neighbors of the students who moved are updated.
+    """
+
+    def __init__(self, alloc):
+        self.alloc = alloc
+        self.neighbors = conflict_graph(alloc.students)
+        for stu in alloc.students:
+            for stu2 in stu.affinity:
+                self.neighbors.setdefault(stu, set()).add(stu2)
+        self.costs = {}
+        for stu in alloc.students:
+            for proj in alloc.projects:
+                self.costs[stu, proj] = alloc.cost(stu, proj)
+
+    def pair_cost(self, stu1, stu2):
+        """what do conflicts (less the affinity) between stu1 and
+        stu2 cost if they are on the same team"""
+        return (CONFLICTCOST * ((stu2 in stu1.antistus) +
+                                (stu1 in stu2.antistus)) -
+                stu1.affinity.get(stu2, 0))
+
+    def cost_swap(self, stu1, stu2):
+        """what is the net change in cost of swapping stu1 and stu2"""
+        p1, p2 = self.alloc.ison[stu1], self.alloc.ison[stu2]
+        if p1 is p2:
+            return 0
+        c = self.costs
+        return (c[stu1, p2] + c[stu2, p1] - c[stu1, p1] - c[stu2, p2] -
+                2 * self.pair_cost(stu1, stu2) +
+                self.alloc.cost_coverage(p1, stu1, stu2) +
+                self.alloc.cost_coverage(p2, stu2, stu1))
+
+    def cost_move(self, stu, dest):
+        """what is the net change in cost of moving stu to dest"""
+        src = self.alloc.ison[stu]
+        if src is dest:
+            return 0
+        c = self.costs
+        return (c[stu, dest] - c[stu, src] +
+                self.alloc.cost_staffing(src, dest) +
+                self.alloc.cost_coverage(src, out=stu) +
+                self.alloc.cost_coverage(dest, inn=stu))
+
+    def cheapest_swaps(self, stu1, limit=100):
+        """return a list of (cost, student) tuples for the swaps that
+        cost less than limit, in increasing order of cost"""
+        ison = self.alloc.ison
+        t = [(self.cost_swap(stu1, stu2), stu2)
+             for stu2 in self.alloc.students
+             if ison[stu1] is not ison[stu2]]
+        t = [(cost, stu) for cost, stu in t if cost<limit]
+        t.sort()
+        return t
+
+    def cheapest_moves(self, stu, limit=100):
+        """return a list of (cost, project) tuples for the moves that
+        cost less than limit, in increasing order of cost"""
+        src = self.alloc.ison[stu]
+        t = [(self.cost_move(stu, proj), proj)
+             for proj in self.alloc.projects if proj is not src]
+        t = [(cost, proj) for cost, proj in t if cost<limit]
+        t.sort()
+        return t
+
+    def dump_options(self, stu):
+        """print the cheapest swaps and moves for stu"""
+        print stu, self.alloc.ison[stu]
+
+        for cost, stu2 in self.cheapest_swaps(stu):
+            proj = self.alloc.ison[stu2]
+            print '    %d\t%20.20s %8.8s  %s %s' % (cost, stu2,
+                                           stu2.major, stu2.gpa,
+                                           str(proj)[:30])
+
+        print ''
+        for cost, proj in self.cheapest_moves(stu):
+            print '    %d\t%s' % (cost, str(proj)[:30])
+
+        print ''
+
+    def update(self, stus, projects):
+        """after stus have moved between projects, recompute the
+        entries that changed"""
+        for stu in stus:
+            for stu2 in self.neighbors.get(stu, []):
+                for proj in projects:
+                    self.costs[stu2, proj] = self.alloc.cost(stu2, proj)
+
+    def swap(self, stu1, stu2):
+        """swap stu1 and stu2 and update the index"""
+        projects = [self.alloc.ison[stu1], self.alloc.ison[stu2]]
+        self.alloc.swap(stu1, stu2)
+        self.update([stu1, stu2], projects)
+
+    def move(self, stu, dest):
+        """move stu to dest and update the index"""
+        projects = [self.alloc.ison[stu], dest]
+        self.alloc.move(stu, dest)
+        self.update([stu], projects)
+
+
+def lns_accepts(delta):
+    """should LNS keep a change that raised the score by delta?"""
+    if LNS_ACCEPT == 'better':
+        return delta < 0
+    if LNS_ACCEPT == 'equal':
+        return delta <= 0
+    if LNS_ACCEPT == 'threshold':
+        return delta <= LNS_THRESHOLD
+    if LNS_ACCEPT == 'anneal':
+        return delta <= 0 or random.random() < math.exp(-delta /
+                                                        LNS_TEMPERATURE)
+    raise ValueError('Unknown LNS_ACCEPT: %s' % LNS_ACCEPT)
 
 
 def make_random_alloc(survey):
@@ -681,31 +1614,184 @@ def make_greedy_alloc(survey):
     return alloc
 
 
-def make_greedy_alloc2(survey):
-    """make an allocation using a greedy algorithm: loop through
-    the projects in random order and let each of them choose the
-    best fit among the remaining students."""
+def make_conflict_alloc(survey):
+    """make an allocation that avoids conflicts from the start.
+
+    Students in the conflict graph are placed first: the biggest
+    components first, and within each component the cliques first,
+    then the students with the highest tally.  Everyone else follows
+    in random order.  Each student goes on the project with room
+    where their placement and conflict costs are lowest.
+    """
     alloc = Allocation(survey)
+    neighbors = conflict_graph(alloc.students)
 
-    students = survey.students[:]
-    projects = survey.projects[:]
+    order = []
+    clique_of = {}
+    for clique in find_cliques(neighbors):
+        for stu in clique:
+            clique_of[stu] = len(clique)
 
-    while 1:
-        random.shuffle(projects)
+    for component in conflict_components(neighbors):
+        t = [(clique_of[stu], stu.tally + len(neighbors[stu]),
+              random.random(), stu) for stu in component]
+        t.sort(reverse=True)
+        order.extend(stu for _, _, _, stu in t)
 
-        for proj in projects:
-            if alloc.num(proj) >= MAXSTAFF:
-                continue
+    rest = [stu for stu in alloc.students if stu not in neighbors]
+    random.shuffle(rest)
+    order.extend(rest)
+
+    for stu in order:
+        _, _, proj = min(placement_costs(alloc, stu, neighbors))
+        alloc.add(stu, proj)
+
+    return alloc
 
-            stus = [(alloc.cost(stu, proj), random.random(), stu)
-                    for stu in students]
 
-            cost, rand, stu = min(stus)
+def placement_costs(alloc, stu, neighbors, allowed=None):
+    """return a list of (cost, rank, project) tuples for the projects
+    (in allowed, if given) with room for stu, or for all of them if
+    none has room.
+
+    cost is PREFCOST plus CONFLICTCOST for each conflict with the
+    students already placed, less the affinity with them; rank is the
+    position of the project in alloc.ranked[stu], which breaks ties
+    in favor of preferred ones.
+    """
+    conflicts = Hist()
+    for stu2 in neighbors.get(stu, []):
+        proj = alloc.ison.get(stu2)
+        if proj:
+            conflicts[proj] = (conflicts.get(proj, 0) +
+                               (stu2 in stu.antistus) +
+                               (stu in stu2.antistus))
+
+    bonus = Hist()
+    for stu2, w in stu.affinity.iteritems():
+        proj = alloc.ison.get(stu2)
+        if proj:
+            bonus[proj] = bonus.get(proj, 0) + w
+
+    projects = alloc.ranked[stu]
+    if allowed is not None:
+        projects = [proj for proj in projects if proj in allowed]
+    roomy = [proj for proj in projects if alloc.num(proj) < proj.maxstaff]
+    if roomy:
+        projects = roomy
+
+    return [(PREFCOST[stu.prefs[proj]] +
+             CONFLICTCOST * conflicts.get(proj, 0) - bonus.get(proj, 0),
+             i, proj)
+            for i, proj in enumerate(projects)]
+
+
+def make_alloc_from(survey, assignment):
+    """make an allocation from a map from student id to project
+    index, as returned by Allocation.assignment; students who are
+    not in the map (or whose project is gone) are absorbed as new
+    arrivals"""
+    alloc = Allocation(survey)
+    projects = dict((proj.i, proj) for proj in alloc.projects)
+
+    for stu in alloc.students:
+        proj = projects.get(assignment.get(stu.stuid))
+        if proj:
             alloc.add(stu, proj)
-            students.remove(stu)
 
-            if len(students) == 0:
-                return alloc
+    new = [stu for stu in alloc.students if stu not in alloc.ison]
+    if new:
+        alloc.students = [stu for stu in alloc.students if stu in alloc.ison]
+        alloc.absorb(new)
+    return alloc
+
+
+def load_alloc(survey, filename):
+    """load an allocation saved by Allocation.pickle (or an older
+    pickled Allocation) and rebuild it against survey"""
+    fp = open(filename, 'rb')
+    saved = pickle.load(fp)
+    fp.close()
+    if isinstance(saved, Allocation):
+        saved = saved.assignment()
+    alloc = make_alloc_from(survey, dict(saved))
+    alloc.note_conflicts()
+    return alloc
+
+
+def make_greedy_alloc2(survey):
+    """make an allocation using a regret heuristic: repeatedly place
+    the student with the biggest gap between the cost of their best
+    and second-best open project, since they have the most to lose
+    by waiting.
+
+    The students are kept in a heap keyed on regret.  After each
+    placement, only the students who had the affected project in
+    their top two are re-evaluated: all of them if it just filled,
+    otherwise only those who conflict with the student placed.  The
+    students with an affinity for the one placed are re-evaluated
+    too, since the project may have become their best.
+    """
+    alloc = Allocation(survey)
+    regret_insert(alloc, alloc.students)
+    return alloc
+
+
+def regret_insert(alloc, stus, allowed=None):
+    """place stus (who must not be on a team) on the projects in
+    allowed (default: all of them) using the regret heuristic
+    described in make_greedy_alloc2"""
+    neighbors = conflict_graph(alloc.students)
+
+    heap = []
+    version = Hist()
+    watched = {}       # map from student to their top two projects
+    watchers = {}      # map from project to students watching it
+    for proj in alloc.projects:
+        watchers[proj] = set()
+
+    def evaluate(stu):
+        for proj in watched.get(stu, []):
+            watchers[proj].discard(stu)
+
+        t = placement_costs(alloc, stu, neighbors, allowed)
+        top = heapq.nsmallest(2, t)
+        if len(top) == 2:
+            regret = top[1][0] - top[0][0]
+        else:
+            regret = float('Inf')
+
+        watched[stu] = [proj for _, _, proj in top]
+        for proj in watched[stu]:
+            watchers[proj].add(stu)
+
+        version.count(stu)
+        heapq.heappush(heap, (-regret, random.random(), version[stu], stu))
+
+    for stu in stus:
+        evaluate(stu)
+
+    while heap:
+        _, _, v, stu = heapq.heappop(heap)
+        if v != version[stu] or alloc.ison.get(stu):
+            continue
+
+        proj = watched[stu][0]
+        for p in watched.pop(stu):
+            watchers[p].discard(stu)
+        alloc.add(stu, proj)
+
+        if alloc.num(proj) >= proj.maxstaff:
+            affected = set(watchers[proj])
+        else:
+            affected = set(stu2 for stu2 in neighbors.get(stu, [])
+                           if stu2 in watchers[proj])
+
+        # a friend on proj can make it the best choice even for a
+        # student who wasn't watching it
+        affected.update(stu2 for stu2 in stu.affinity if stu2 in watched)
+        for stu2 in affected:
+            evaluate(stu2)
 
 
 class Project(object):
@@ -733,7 +1819,7 @@ class Student(object):
     """Represents a student."""
 
     def __init__(self, stuid, prefs, roles, skills, email,
-                               antinames, comment, major):
+                               antinames, comment, major, friendnames=()):
         self.stuid = stuid
         self.prefs = prefs
         self.maxpref = max(prefs.values())
@@ -749,13 +1835,47 @@ class Student(object):
         self.antistus = []
         self.tally = 0
 
+        # friendnames is a list of the teammates this student asked
+        # for, and friendstus the corresponding Student objects.
+        # affinity maps from each student linked to this one, in
+        # either direction, to the total bonus for being together.
+        self.friendnames = list(friendnames)
+        self.friendstus = []
+        self.affinity = {}
+
         self.comment = clean(comment)
         self.major = major
         self.locked = False
 
+    def __getstate__(self):
+        """pickle without the links to other students, which would
+        make the pickler walk the whole friend graph; they are
+        rebuilt by Survey.process_friends"""
+        state = self.__dict__.copy()
+        del state['friendstus']
+        del state['affinity']
+        return state
+
+    def __setstate__(self, state):
+        """load students pickled before there were affinities"""
+        self.friendnames = []
+        self.friendstus = []
+        self.affinity = {}
+        self.__dict__.update(state)
+
     def __str__(self):
         return self.name
 
+    def link(self, other, weight):
+        """add weight to the affinity between this student and other
+        (in both directions)"""
+        for a, b in [(self, other), (other, self)]:
+            total = a.affinity.get(b, 0) + weight
+            if total:
+                a.affinity[b] = total
+            else:
+                a.affinity.pop(b, None)
+
     def set_name(self, last, first):
         self.last = last
         self.first = first
@@ -847,6 +1967,19 @@ class Survey(object):
         # students is a fuzzy mapping from names to student objects
         self.students = FuzzyDict(cutoff=0.6)
 
+        # rows maps from a student's key to his/her row of the
+        # survey; unresolved is a list of (student, antiname) pairs
+        # that process_conflicts could not find, and
+        # unresolved_friends the same for process_friends
+        self.rows = {}
+        self.unresolved = []
+        self.unresolved_friends = []
+        self.num_friends = 0
+
+        # mtime is the modification time of the survey file, or
+        # None for surveys that were not read from one
+        self.mtime = None
+
     def parse(self, filename):
         """Reads the given file and builds the survey."""
 
@@ -889,62 +2022,138 @@ class Survey(object):
         n = self.num_prefs = len(self.project_codes)
         m = self.num_skills = len(self.skills)
 
+        # the teammate columns come right after the skills
+        self.num_friends = len([title for title in titles
+                                if 'teammate' in title])
+
         #for i, title in enumerate(titles):
         #    print i, title
 
         # parse the lines
         for t in reader:
             # print t
+            stu = self.parse_row(t)
+            key = stu.name.lower()
+            self.students[key] = stu
+            self.rows[key] = t
+
+        self.mtime = os.path.getmtime(filename)
+
+        # for each project, build the mapping from preferences
+        # to students.
+        for student in self.students.values():
+            for proj, pref in student.prefs.iteritems():
+                proj.add(student, pref)
 
-            survey_id = t[0]
-            #completed = t[1]
+    def parse_row(self, t):
+        """Makes a Student from a row of the survey."""
+        n = self.num_prefs
+        m = self.num_skills
 
-            j = 1
-            i, j = j, j+n
-            prefs = t[i:j]
+        survey_id = t[0]
+        #completed = t[1]
 
-            i, j = j, j+2
-            antinames = [name.strip() for name in t[i:j]]
+        j = 1
+        i, j = j, j+n
+        prefs = t[i:j]
 
-            i, j = j, j+4
-            roles = t[i:j]
+        i, j = j, j+2
+        antinames = [name.strip() for name in t[i:j]]
 
-            i, j = j, j+m
-            skills = t[i:j]
+        i, j = j, j+4
+        roles = t[i:j]
 
-            major = t[-5]
-            major2 = t[-4]
-            comment = t[-3]
-            email = t[-2]
-	    stuid = t[-1]
+        i, j = j, j+m
+        skills = t[i:j]
 
-            if major2:
-                comment = major2 + "\n\n" + comment
+        i, j = j, j+self.num_friends
+        friendnames = [name.strip() for name in t[i:j]]
 
-            try:
-                prefs = [int(x) for x in prefs]
-            except ValueError:
-                print 'Bad prefs', email, prefs
+        major = t[-5]
+        major2 = t[-4]
+        comment = t[-3]
+        email = t[-2]
+        stuid = t[-1]
 
-            # prefs is a map from Project object to int
-            prefs = dict(zip(self.projects, prefs))
+        if major2:
+            comment = major2 + "\n\n" + comment
 
-            # extend prefs with bogus votes for secret projects
-            for proj in self.locked_projects:
-                prefs[proj] = 1
+        try:
+            prefs = [int(x) for x in prefs]
+        except ValueError:
+            print 'Bad prefs', email, prefs
+
+        # prefs is a map from Project object to int
+        prefs = dict(zip(self.projects, prefs))
 
-            stu = Student(stuid, prefs, roles, skills, email,
-                          antinames, comment, major)
-            self.get_token_info(stu)
+        # extend prefs with bogus votes for secret projects
+        for proj in self.locked_projects:
+            prefs[proj] = 1
+
+        stu = Student(stuid, prefs, roles, skills, email,
+                      antinames, comment, major, friendnames)
+        self.get_token_info(stu)
+        return stu
+
+    def update(self, filename):
+        """Reads the given file again and takes in only the rows that
+        are new or have changed since the last time.
+
+        New students are added.  Students who changed their responses
+        are updated in place, so allocations that refer to them stay
+        valid.  Returns the list of new and changed students.
+        """
+        fp = open(filename)
+        reader = csv.reader(fp)
+        _titles = reader.next()
 
+        stus = []
+        for t in reader:
+            stu = self.parse_row(t)
             key = stu.name.lower()
-            self.students[key] = stu
+            if self.rows.get(key) == t:
+                continue
+            self.rows[key] = t
+
+            # use dict.get, since FuzzyDict would match a new student
+            # to someone else
+            old = dict.get(self.students, key)
+            if old:
+                # forget the old responses, but keep the tally,
+                # which belongs to the students who named this one
+                for proj in self.projects:
+                    for students in proj.students.itervalues():
+                        if old in students:
+                            students.remove(old)
+                for stu2 in old.antistus:
+                    stu2.tally -= 1
+                stu.tally = old.tally
+
+                # likewise for the affinities
+                for stu2 in old.friendstus:
+                    old.link(stu2, -AFFINITYBONUS)
+                stu.affinity = old.affinity
+                old.__dict__.update(stu.__dict__)
+                stu = old
+            else:
+                self.students[key] = stu
 
-        # for each project, build the mapping from preferences
-        # to students.
-        for student in self.students.values():
-            for proj, pref in student.prefs.iteritems():
-                proj.add(student, pref)
+            for proj, pref in stu.prefs.iteritems():
+                proj.add(stu, pref)
+            stus.append(stu)
+
+        self.mtime = os.path.getmtime(filename)
+        return stus
+
+    def subset(self, students, projects):
+        """Returns a Survey that shares Student and Project objects
+        with this one, but contains only the given ones."""
+        sub = Survey(self.tokens)
+        sub.skills = self.skills
+        sub.projects = projects
+        for stu in students:
+            sub.students[stu.name.lower()] = stu
+        return sub
 
     def get_token_info(self, student):
         """Adds information from STUDENTFILE to the student.
@@ -966,27 +2175,61 @@ class Survey(object):
 
         student.set_name(token.last, token.first)
 
-    def process_conflicts(self):
-        """For each student, convert from antinames (string)
-        to antistus (student objects) using the fuzzy dictionary
+    def process_conflicts(self, stus=None):
+        """For each student (or each of stus), convert from antinames
+        (string) to antistus (student objects) using the fuzzy
+        dictionary.  Names that could not be found before are tried
+        again, in case they belong to students who just arrived.
         """
         # fixers is a map from known problem names to canonical names
         fixers = {
             }
 
-        stus = self.students.values()
-        for stu in stus:
-            for name in stu.antinames:
-                if name == '': continue
-                if name in fixers:
-                    name = fixers[name]
-                try:
-                    stu2 = self.find_student(name)
-                    stu.antistus.append(stu2)
-                    stu2.tally += 1
-                except KeyError:
-                    print ('Could not process conflict %s -> %s' %
-                           (stu.name, name))
+        if stus is None:
+            stus = self.students.values()
+        pending = [(stu, name) for stu in stus for name in stu.antinames]
+        pending += [(stu, name) for stu, name in self.unresolved
+                    if stu not in stus]
+        self.unresolved = []
+
+        for stu, name in pending:
+            if name == '': continue
+            if name in fixers:
+                name = fixers[name]
+            try:
+                stu2 = self.find_student(name)
+                stu.antistus.append(stu2)
+                stu2.tally += 1
+            except KeyError:
+                print ('Could not process conflict %s -> %s' %
+                       (stu.name, name))
+                self.unresolved.append((stu, name))
+
+    def process_friends(self, stus=None):
+        """For each student (or each of stus), convert from
+        friendnames to friendstus and add AFFINITYBONUS to the
+        affinity of each pair.  Like process_conflicts, names that
+        could not be found before are tried again.
+        """
+        if stus is None:
+            stus = self.students.values()
+        pending = [(stu, name) for stu in stus for name in stu.friendnames]
+        pending += [(stu, name) for stu, name in self.unresolved_friends
+                    if stu not in stus]
+        self.unresolved_friends = []
+
+        for stu, name in pending:
+            if name == '': continue
+            try:
+                stu2 = self.find_student(name)
+            except KeyError:
+                print ('Could not process teammate %s -> %s' %
+                       (stu.name, name))
+                self.unresolved_friends.append((stu, name))
+                continue
+            if stu2 is not stu:
+                stu.friendstus.append(stu2)
+                stu.link(stu2, AFFINITYBONUS)
 
     def fix_whiners(self):
         """
@@ -1035,14 +2278,18 @@ class Survey(object):
                 print 'restricted', proj
                 proj.restricted = True
 
-    def lock_students(self):
-        """Lock some students onto a particular project."""
+    def lock_students(self, stus=None):
+        """Lock some students (of stus, if given) onto a particular
+        project."""
         for stuname, projname in LOCKED_STUDENTS:
             try:
                 stu = self.find_student(stuname)
             except KeyError:
                 print "Can't find locked student", stuname
 
+            if stus is not None and stu not in stus:
+                continue
+
             proj = self.find_project(projname)
             if proj == None:
                 print "Can't find project %s" % projname
@@ -1058,23 +2305,29 @@ class Survey(object):
             else:
                 stu.prefs[proj] = 1
 
-    def bar_noncitizens(self):
-        """Change the preferences of noncitizens so they will not
-        be put on restricted projects.
+    def bar_noncitizens(self, stus=None):
+        """Change the preferences of noncitizens (among stus, if
+        given) so they will not be put on restricted projects.
         """
-        for stu in self.students.values():
+        if stus is None:
+            stus = self.students.values()
+        for stu in stus:
             for proj in self.projects:
                 if proj.restricted and not stu.is_citizen:
                     self.bar_student(stu, proj)
 
-    def bar_students(self):
-        """Bar some students from a particular project."""
+    def bar_students(self, stus=None):
+        """Bar some students (of stus, if given) from a particular
+        project."""
         for stuname, projname in BARRED_STUDENTS:
             try:
                 stu = self.find_student(stuname)
             except KeyError:
                 print "Can't find locked student", stuname
 
+            if stus is not None and stu not in stus:
+                continue
+
             proj = self.find_project(projname)
             if proj == None:
                 print "Can't find project %s" % projname
@@ -1190,12 +2443,13 @@ def skill_string(stu, skill_names):
 
 
 def generate_alloc(survey, n=10):
-    """generate greedy allocations, return the one with lowest cost
+    """generate conflict-aware greedy allocations, return the one
+    with lowest cost
     """
     best = (float('Inf'), None)
 
     for i in range(n):
-        alloc = make_greedy_alloc(survey)
+        alloc = make_conflict_alloc(survey)
         alloc.fix_understaff()
         score = alloc.score()
 
@@ -1205,6 +2459,189 @@ def generate_alloc(survey, n=10):
     return best
 
 
+def past(deadline):
+    """has time.time() passed deadline (None for no deadline)?"""
+    return deadline is not None and time.time() > deadline
+
+
+def search(survey, budget, progress=None):
+    """run the generate-and-improve loop from optimize for budget
+    seconds, return (score, assignment) for the best allocation found.
+    If given, progress is called with each new best score.  Even if
+    the budget runs out right away, the first allocation generated is
+    returned.
+    """
+    deadline = time.time() + budget
+    best = (float('Inf'), None)
+
+    while best[1] is None or time.time() < deadline:
+        score, alloc = generate_alloc(survey, 1)
+        prev = score
+        if score < best[0]:
+            best = (score, alloc.assignment())
+            if progress:
+                progress(score)
+
+        while time.time() < deadline:
+            alloc.fix_and_swap(deadline=deadline)
+            score = alloc.score()
+
+            if score < best[0]:
+                best = (score, alloc.assignment())
+                if progress:
+                    progress(score)
+
+            if score >= prev:
+                break
+            prev = score
+
+            kick(alloc)
+
+    return best
+
+
+def kick(alloc, strength=1, how=None):
+    """perturb alloc out of its local optimum, strength times; how is
+    one of the values of KICK, which is the default"""
+    if (how or KICK) == 'lns':
+        for i in range(LNS_ROUNDS * strength):
+            alloc.lns()
+    else:
+        for i in range(strength):
+            alloc.desperate()
+
+
+def lower_bound(survey):
+    """compute a lower bound on the score of any allocation.
+
+    Placement costs are bounded by a min-cost flow that assigns every
+    student to a project within the staffing limits, ignoring
+    conflicts and GPAs.  Conflicts are bounded by pigeonhole: a group
+    of k students who all conflict with each other can't be spread
+    over fewer than k teams without conflicts.  At best, every pair
+    with an affinity ends up together, which costs nothing.
+    """
+    students = survey.students.values()
+    projects = survey.projects
+
+    placed, cost, edges = staffing_flow(students, projects)
+    minimum = sum(proj.minstaff for proj in projects)
+    if placed < len(students) or len(students) < minimum:
+        # every allocation is over or understaffed
+        return min(OVERCOST, UNDERCOST)
+
+    bound = cost + CONFLICTCOST * forced_conflicts(students, len(projects))
+
+    # an allocation that breaks the staffing limits pays at least
+    # the staffing penalty
+    return min(bound, OVERCOST, UNDERCOST)
+
+
+def staffing_flow(students, projects):
+    """assign students to projects within the staffing limits at the
+    lowest total of PREFCOST and non-citizen penalties, ignoring
+    conflicts and GPAs.
+
+    Returns (placed, cost, assignment), where placed is the number of
+    students assigned and assignment maps from student to project.
+    """
+    # filling a project up to minstaff earns a bonus big enough that
+    # the flow always satisfies the minimums when it can
+    big = 1 + len(students) * max(PREFCOST[1:])
+
+    flow = MinCostFlow()
+    edges = {}
+    for stu in students:
+        flow.add_edge('source', stu, 1, 0)
+        for proj in projects:
+            cost = PREFCOST[stu.prefs[proj]]
+            if proj.restricted and not stu.is_citizen:
+                cost += NONCITIZENCOST
+            edges[stu, proj] = flow.add_edge(stu, proj, 1, cost)
+
+    bonus = []
+    for proj in projects:
+        bonus.append(flow.add_edge(proj, 'sink', proj.minstaff, -big))
+        flow.add_edge(proj, 'sink', proj.maxstaff - proj.minstaff, 0)
+
+    placed, cost = flow.solve('source', 'sink')
+    cost += big * sum(flow.flow(e) for e in bonus)
+
+    assignment = {}
+    for (stu, proj), e in edges.iteritems():
+        if flow.flow(e):
+            assignment[stu] = proj
+    return placed, cost, assignment
+
+
+def conflict_graph(students):
+    """return a map from each student with a conflict to the set of
+    students who named them or whom they named"""
+    neighbors = {}
+    for stu in students:
+        for anti in stu.antistus:
+            neighbors.setdefault(stu, set()).add(anti)
+            neighbors.setdefault(anti, set()).add(stu)
+    return neighbors
+
+
+def conflict_components(neighbors):
+    """return the connected components of the conflict graph as lists
+    of students, largest first"""
+    seen = set()
+    components = []
+    for stu in neighbors:
+        if stu in seen:
+            continue
+        seen.add(stu)
+        component = [stu]
+        for x in component:
+            for y in neighbors[x]:
+                if y not in seen:
+                    seen.add(y)
+                    component.append(y)
+        components.append(component)
+
+    components.sort(key=len, reverse=True)
+    return components
+
+
+def find_cliques(neighbors):
+    """partition the students in the conflict graph into disjoint
+    groups who all conflict with each other, grown greedily from
+    the most-connected students; return the groups, largest first"""
+    t = [(len(nbrs), stu) for stu, nbrs in neighbors.iteritems()]
+    t.sort(reverse=True)
+    used = set()
+    cliques = []
+    for _, stu in t:
+        if stu in used:
+            continue
+        clique = [stu]
+        for stu2 in neighbors[stu]:
+            if stu2 not in used and all(stu2 in neighbors[x]
+                                        for x in clique):
+                clique.append(stu2)
+        used.update(clique)
+        cliques.append(clique)
+
+    cliques.sort(key=len, reverse=True)
+    return cliques
+
+
+def forced_conflicts(students, num_teams):
+    """find disjoint groups of students who all conflict with each
+    other and return the number of conflicts that can't be avoided
+    when they are spread over num_teams teams"""
+    total = 0
+    for clique in find_cliques(conflict_graph(students)):
+        # spreading k students as evenly as possible over the teams
+        # still puts some pairs together
+        q, r = divmod(len(clique), num_teams)
+        total += r * (q+1) * q / 2 + (num_teams - r) * q * (q-1) / 2
+    return total
+
+
 def make_survey():
     """read the survey data and populate the global variable survey"""
     tokens = Tokens(STUDENTFILE)
@@ -1212,6 +2649,7 @@ def make_survey():
     survey.parse(SURVEYFILE)
 
     survey.process_conflicts()
+    survey.process_friends()
     #survey.fix_whiners()
 
     # we are not using check_citizenship any more;
@@ -1225,6 +2663,148 @@ def make_survey():
     return survey
 
 
+def max_low_gpa(projects, n):
+    """the most students with GPA<3.0 that teams on projects can hold
+    without exceeding GPA_LIMITS, over all ways of staffing them with
+    n students in total; None if they can't be staffed at all"""
+    # best maps from a number of students placed to the most low
+    # GPAs the teams so far can hold
+    best = {0: 0}
+    for proj in projects:
+        new = {}
+        for placed, low in best.iteritems():
+            for size in range(proj.minstaff, proj.maxstaff+1):
+                if placed + size > n:
+                    break
+                total = low + GPA_LIMITS.get(size, size)
+                if total > new.get(placed + size, -1):
+                    new[placed + size] = total
+        best = new
+    return best.get(n)
+
+
+def preflight(survey):
+    """check that the survey can be allocated at all: staffing,
+    restrictions, locks and bars.  Prints warnings for problems that
+    only cost points, and returns a list of the problems that no
+    allocation can get around.
+
+    While the survey is partial (fewer responses than students in
+    the token database), too few students to staff the projects is
+    only a warning, since the rest may still answer."""
+    problems = []
+    projects = survey.projects
+    stus = survey.students.values()
+    n = len(stus)
+
+    expected = len(survey.tokens.map) if survey.tokens else n
+    if n < expected:
+        print 'Warning: only %d of %d students have answered' % (n, expected)
+        shortfalls = []
+    else:
+        shortfalls = problems
+
+    # total capacity against headcount
+    lo = sum(proj.minstaff for proj in projects)
+    hi = sum(proj.maxstaff for proj in projects)
+    if n < lo:
+        shortfalls.append('%d students can\'t staff %d projects that need '
+                          'at least %d' % (n, len(projects), lo))
+    if n > hi:
+        problems.append('%d students don\'t fit on %d projects that hold '
+                        'at most %d' % (n, len(projects), hi))
+
+    # restricted capacity against citizens
+    restricted = [proj for proj in projects if proj.restricted]
+    citizens = len([stu for stu in stus if stu.is_citizen])
+    need = sum(proj.minstaff for proj in restricted)
+    if citizens < need:
+        names = ', '.join(proj.name for proj in restricted)
+        shortfalls.append('%d citizens can\'t staff restricted projects '
+                          '%s, which need at least %d' %
+                          (citizens, names, need))
+    room = sum(proj.maxstaff for proj in projects if not proj.restricted)
+    if n - citizens > room:
+        problems.append('%d noncitizens don\'t fit on the unrestricted '
+                        'projects, which hold at most %d' %
+                        (n - citizens, room))
+
+    # locks against capacity, restrictions and bars
+    barred = set()
+    for stuname, projname in BARRED_STUDENTS:
+        try:
+            barred.add((survey.find_student(stuname), projname))
+        except KeyError:
+            pass
+
+    locked = Mdict()
+    for stuname, projname in LOCKED_STUDENTS:
+        try:
+            stu = survey.find_student(stuname)
+        except KeyError:
+            continue
+        proj = survey.find_project(projname)
+        if proj is None:
+            continue
+        locked[proj] = stu
+        if (stu, projname) in barred:
+            print 'Warning: %s is locked onto and barred from %s' % (
+                stu.name, projname)
+        if proj.restricted and not stu.is_citizen:
+            print 'Warning: noncitizen %s is locked onto restricted %s' % (
+                stu.name, projname)
+
+    for proj, t in locked.iteritems():
+        if len(t) > proj.maxstaff:
+            problems.append('%d students are locked onto %s, which holds '
+                            'at most %d' % (len(t), proj.name, proj.maxstaff))
+
+    if shortfalls is not problems:
+        for shortfall in shortfalls:
+            print 'Warning: so far, %s' % shortfall
+
+    # the low GPAs against what GPA_LIMITS allow
+    low = len([stu for stu in stus if float(stu.gpa) < 3.0])
+    most = max_low_gpa(projects, n)
+    if most is not None and low > most:
+        print 'Warning: %d students with GPA<3.0, but GPA_LIMITS allow ' \
+              'at most %d' % (low, most)
+
+    return problems
+
+
+def check_feasible(survey):
+    """run preflight on survey before optimizing it, and exit if no
+    allocation can satisfy it"""
+    problems = preflight(survey)
+    if problems:
+        for problem in problems:
+            print 'Infeasible:', problem
+        sys.exit()
+
+
+def update_survey(survey):
+    """read the rows of SURVEYFILE that are new or have changed since
+    the survey was parsed, process those students the same way
+    make_survey does, and return the list of them"""
+    stus = survey.update(SURVEYFILE)
+    if stus:
+        print 'read %d new or changed responses' % len(stus)
+        survey.process_conflicts(stus)
+        survey.process_friends(stus)
+        survey.bar_noncitizens(stus)
+        survey.lock_students(stus)
+        survey.bar_students(stus)
+    return stus
+
+
+def survey_changed(survey):
+    """has SURVEYFILE been modified since it was last read?"""
+    if survey.mtime is None:
+        return False
+    return os.path.getmtime(SURVEYFILE) != survey.mtime
+
+
 def optimize():
     """run an infinite loop that generates allocations and tries
     to improve them, recording good solutions as it goes.
@@ -1234,35 +2814,951 @@ def optimize():
     if len(survey.students) < 10:
         print 'Not enough students.'
         sys.exit()
+    check_feasible(survey)
 
-    best = (float('Inf'), None)
+    Optimizer(survey).run()
 
-    while 1:
-        # print 'generating new allocation'
-        score, alloc = generate_alloc(survey, 1)
-        prev = score
+
+def resume():
+    """continue the run saved in CHECKPOINT_FILE"""
+    survey = make_survey()
+    check_feasible(survey)
+    Optimizer.load(survey, CHECKPOINT_FILE).run()
+
+
+class Optimizer(object):
+    """the state of the search in optimize, kept together so it can
+    be checkpointed and resumed.
+
+    alloc: the allocation being improved, or None between allocations
+    prev: the score of alloc after the last round
+    best: (score, snapshot) for the best allocation so far
+    bound: the lower bound on the score
+    stats: Hist of how many times each step was taken
+    elite: ElitePool of good allocations
+    visited: set of the signatures of the local optima seen so far
+    strength: how many times to kick alloc, which goes up each time
+              fix_and_swap lands on a local optimum it has seen before
+    operators: Scheduler for the operators in fix_and_swap
+    kicks: Scheduler for the kicks
+    kicked: (kick, CPU time, score before) for the last kick, which
+            is judged by the local optimum that follows it, or None
+    """
+
+    def __init__(self, survey):
+        self.survey = survey
+        self.alloc = None
+        self.prev = None
+        self.best = (float('Inf'), None)
+        self.bound = lower_bound(survey)
+        self.stats = Hist()
+        self.elite = ElitePool(survey)
+        self.visited = set()
+        self.strength = 1
+        self.operators = Scheduler(OPERATORS)
+        self.kicks = Scheduler(KICKS)
+        self.kicked = None
+        print 'lower bound is %d' % self.bound
+
+    def step(self):
+        """run one round of improvement (starting a new allocation
+        if necessary); return True when the search is over"""
+        survey = self.survey
+        if self.alloc is None:
+            # print 'generating new allocation'
+            self.prev, self.alloc = generate_alloc(survey, 1)
+            self.stats.count('restarts')
+            self.kicked = None
+        alloc = self.alloc
+
+        # take in new survey responses as they arrive; the scores so
+        # far are for the old survey, so the elite pool is saved and
+        # replaced
+        if survey_changed(survey):
+            self.elite.flush()
+            alloc.absorb(update_survey(survey))
+            self.elite = ElitePool(survey)
+            self.bound = lower_bound(survey)
+            self.best = (float('Inf'), None)
+            self.prev = float('Inf')
+            self.visited = set()
+
+        alloc.fix_and_swap(self.visited,
+                           self.operators if SCHEDULE else None)
+        score = alloc.score()
+        self.stats.count('rounds')
+
+        if self.kicked:
+            how, start, before = self.kicked
+            self.kicks.record(how, before - score, time.clock() - start)
+            self.kicked = None
+
+        # if we have been here before, kick harder, and after
+        # REVISIT_LIMIT revisits in a row, start over
+        if alloc.signature in self.visited:
+            self.stats.count('revisits')
+            self.strength += 1
+            if self.strength > REVISIT_LIMIT:
+                self.alloc = None
+                self.strength = 1
+            else:
+                self.kick(alloc, score)
+            return False
+        self.visited.add(alloc.signature)
+        self.strength = 1
+
+        self.elite.add(score, alloc)
 
         # keep trying to improve it as long as it keeps getting better
-        while 1:
-            swaps = alloc.fix_and_swap()
-            score = alloc.score()
+        if score >= self.prev:
+            # print 'no help'
+            self.alloc = None
+            return False
+        else:
+            # print 'that helped'
+            self.prev = score
+
+        if score < self.best[0]:
+            self.best = (score, alloc.snapshot())
+        print 'best so far is %d (bound %d)\n' % (self.best[0], self.bound),
+
+        if self.best[0] - self.bound <= OPTIMALITY_GAP:
+            print 'within %d of the lower bound' % OPTIMALITY_GAP
+            self.checkpoint()
+            self.elite.flush(max(WORTH_SAVING, self.best[0]))
+            return True
+
+        self.kick(alloc, score)
+        return False
+
+    def kick(self, alloc, score):
+        """perturb alloc out of its local optimum (which scores
+        score), strength times"""
+        # print 'taking desperate measures'
+        how = self.kicks.choose() if SCHEDULE else KICK
+        self.kicked = (how, time.clock(), score)
+        kick(alloc, self.strength, how)
+        self.stats.count(how)
+
+    def run(self):
+        """take steps until the search is over or the user hits
+        Ctrl-C, checkpointing every CHECKPOINT_INTERVAL seconds.
+
+        Ctrl-C is deferred to the end of the current step, so the
+        last checkpoint is always of a consistent state.
+        """
+        interrupted = []
+        handler = signal.signal(signal.SIGINT,
+                                lambda sig, frame: interrupted.append(sig))
+        try:
+            last = time.time()
+            while not self.step():
+                if interrupted:
+                    self.checkpoint()
+                    raise KeyboardInterrupt
+                if time.time() - last > CHECKPOINT_INTERVAL:
+                    self.checkpoint()
+                    last = time.time()
+        finally:
+            signal.signal(signal.SIGINT, handler)
+
+    def best_alloc(self):
+        """return a new Allocation for the best one so far, or None"""
+        if self.best[1] is None:
+            return None
+        alloc = Allocation(self.survey)
+        alloc.restore(self.best[1])
+        return alloc
+
+    def get_state(self):
+        """return a dictionary that encodes the state of the search"""
+        students = sorted(self.survey.students.values(),
+                          key=lambda stu: stu.stuid)
+        stuids = [stu.stuid for stu in students]
+
+        def encode(alloc):
+            return encode_alloc(alloc, stuids) if alloc else None
+
+        return dict(stuids=stuids,
+                    alloc=encode(self.alloc),
+                    prev=self.prev,
+                    best=encode(self.best_alloc()),
+                    stats=dict(self.stats),
+                    visited=list(self.visited),
+                    strength=self.strength,
+                    operators=self.operators.get_state(),
+                    kicks=self.kicks.get_state(),
+                    elite=self.elite.entries,
+                    elite_stuids=self.elite.stuids,
+                    random=random.getstate())
+
+    def set_state(self, state):
+        """restore the search from a dictionary made by get_state.
+        The bound from __init__ is kept and the best allocation is
+        re-scored, since the survey may have changed since."""
+        stuids = state['stuids']
+
+        def decode(code):
+            return decode_alloc(self.survey, stuids, code) if code else None
+
+        self.alloc = decode(state['alloc'])
+        self.prev = state['prev']
+        best = decode(state['best'])
+        if best:
+            self.best = (best.evaluate()[0], best.snapshot())
+        self.stats = Hist(state['stats'])
+        self.visited = set(state.get('visited', []))
+        self.strength = state.get('strength', 1)
+        if 'operators' in state:
+            self.operators.set_state(state['operators'])
+            self.kicks.set_state(state['kicks'])
+        self.elite.restore(state['elite'], state.get('elite_stuids', stuids))
+        random.setstate(state['random'])
+
+    def checkpoint(self, filename=CHECKPOINT_FILE):
+        """save the state of the search and the new members of the
+        elite pool; the file is replaced atomically, so a crash can't
+        leave a partial checkpoint"""
+        self.elite.flush()
+        tmp = filename + '.tmp'
+        fp = open(tmp, 'wb')
+        pickle.dump(self.get_state(), fp, pickle.HIGHEST_PROTOCOL)
+        fp.flush()
+        os.fsync(fp.fileno())
+        fp.close()
+        os.rename(tmp, filename)
 
-            if score <= WORTH_SAVING:
-                alloc.pickle()
+    @staticmethod
+    def load(survey, filename=CHECKPOINT_FILE):
+        """make an Optimizer from a checkpoint"""
+        optimizer = Optimizer(survey)
+        fp = open(filename, 'rb')
+        optimizer.set_state(pickle.load(fp))
+        fp.close()
+        print 'resuming from %s, best so far is %s' % (filename,
+                                                        optimizer.best[0])
+        return optimizer
 
-            if score >= prev:
-                # print 'no help'
-                break
-            else:
-                # print 'that helped'
-                prev = score
 
-            if (score, alloc) < best:
-                best = (score, alloc)
-            print 'best so far is %d\n' % best[0],
+class Scheduler(object):
+    """chooses among operators like a multi-armed bandit.
+
+    names: list of operator names
+    rates: map from name to the moving average of improvement per
+           CPU second, or None if the operator has not been tried
+    uses: Hist of how many times each operator was chosen
+    """
+
+    def __init__(self, names, decay=OPERATOR_DECAY, epsilon=OPERATOR_EPSILON):
+        self.names = list(names)
+        self.decay = decay
+        self.epsilon = epsilon
+        self.rates = dict((name, None) for name in self.names)
+        self.uses = Hist()
+
+    def choose(self, exclude=()):
+        """pick an operator that is not in exclude: one that has not
+        been tried, if any, otherwise (usually) the best rate"""
+        names = [name for name in self.names if name not in exclude]
+        untried = [name for name in names if self.rates[name] is None]
+        if untried:
+            name = random.choice(untried)
+        elif random.random() < self.epsilon:
+            name = random.choice(names)
+        else:
+            _, _, name = max((self.rates[name], random.random(), name)
+                             for name in names)
+        self.uses.count(name)
+        return name
+
+    def record(self, name, gain, seconds):
+        """update the rate of name after it improved the score by
+        gain in seconds"""
+        rate = max(gain, 0) / max(seconds, 1e-6)
+        old = self.rates[name]
+        if old is None:
+            self.rates[name] = rate
+        else:
+            self.rates[name] = old + self.decay * (rate - old)
+
+    def get_state(self):
+        return dict(rates=self.rates, uses=dict(self.uses))
+
+    def set_state(self, state):
+        for name, rate in state['rates'].iteritems():
+            if name in self.rates:
+                self.rates[name] = rate
+        self.uses = Hist(state['uses'])
+
+
+class ElitePool(object):
+    """a bounded pool of good allocations that are not too similar.
+
+    entries is a list of (score, placement) pairs in increasing order
+    of score, where placement is an array of project indices (proj.i)
+    in the order of stuids, the sorted student ids of the survey when
+    the pool was made.  No two entries differ in fewer than
+    min_distance placements, and identical placements are recognized
+    by their Zobrist signature.
+
+    The scores are only comparable within one version of the survey,
+    so when new responses come in, the Optimizer flushes the pool and
+    starts a new one.
+    """
+
+    def __init__(self, survey, size=ELITE_SIZE, min_distance=ELITE_DISTANCE):
+        self.survey = survey
+        self.size = size
+        self.min_distance = min_distance
+        self.stuids = sorted(stu.stuid for stu in survey.students.values())
+        self.entries = []
+        self.signatures = set()
+        self.saved = set()
+
+    def restore(self, entries, stuids):
+        """replace the entries with ones from a checkpoint, whose
+        placements are in the order of stuids.  If the survey is the
+        same, they are assumed to have been saved already; otherwise
+        each one is rebuilt against the current survey (absorbing any
+        new students), re-scored and offered to the pool again."""
+        if list(stuids) == self.stuids:
+            self.entries = entries
+            self.signatures = set(placement_signature(stuids, placement)
+                                  for _, placement in entries)
+            self.saved = set(self.signatures)
+            return
+
+        self.entries = []
+        self.signatures = set()
+        self.saved = set()
+        for _, placement in entries:
+            alloc = make_alloc_from(self.survey,
+                                    dict(zip(stuids, placement)))
+            self.add(alloc.evaluate()[0], alloc)
+
+    def add(self, score, alloc):
+        """offer alloc to the pool; return True if it was taken"""
+        signature = alloc.signature
+        if signature in self.signatures:
+            return False
+        assignment = alloc.assignment()
+        placement = array('H', [assignment.get(stuid, 0)
+                                for stuid in self.stuids])
+
+        # entries that are too close to the newcomer have to go, but
+        # only if they are all worse
+        near = [entry for entry in self.entries
+                if distance(entry[1], placement) < self.min_distance]
+        if any(s <= score for s, _ in near):
+            return False
+        if len(self.entries) - len(near) >= self.size:
+            if self.entries[-1][0] <= score:
+                return False
+            near.append(self.entries[-1])
+
+        for entry in near:
+            self.entries.remove(entry)
+            self.signatures.discard(placement_signature(self.stuids,
+                                                        entry[1]))
+
+        self.entries.append((score, placement))
+        self.entries.sort(key=lambda entry: entry[0])
+        self.signatures.add(signature)
+        return True
+
+    def flush(self, threshold=None):
+        """pickle the entries scoring threshold (by default,
+        WORTH_SAVING) or better that have not been saved yet"""
+        if threshold is None:
+            threshold = WORTH_SAVING
+        for score, placement in self.entries:
+            signature = placement_signature(self.stuids, placement)
+            if score > threshold or signature in self.saved:
+                continue
+            assignment = dict(zip(self.stuids, placement))
+            make_alloc_from(self.survey, assignment).pickle()
+            self.saved.add(signature)
+
+
+def distance(placement1, placement2):
+    """the number of students placed differently"""
+    return sum(1 for a, b in zip(placement1, placement2) if a != b)
 
-            # print 'taking desperate measures'
-            alloc.desperate()
+
+def encode_alloc(alloc, stuids):
+    """encode alloc compactly: for each project, in order, the size of
+    the team followed by the position in stuids of each member.
+
+    Unlike a snapshot, the code stays valid after students join the
+    survey, which is why checkpoints use it.
+    """
+    index = dict((stuid, i) for i, stuid in enumerate(stuids))
+    code = array('H')
+    for proj in alloc.projects:
+        team = alloc.teams[proj]
+        code.append(len(team))
+        code.extend(index[stu.stuid] for stu in team)
+    return code
+
+
+def decode_alloc(survey, stuids, code):
+    """make an allocation from the output of encode_alloc; students
+    who are not in stuids are absorbed as new arrivals"""
+    alloc = Allocation(survey)
+    students = dict((stu.stuid, stu) for stu in alloc.students)
+
+    i = 0
+    for proj in alloc.projects:
+        n = code[i]
+        for k in code[i+1:i+1+n]:
+            alloc.add(students[stuids[k]], proj)
+        i += n + 1
+
+    new = [stu for stu in alloc.students if stu not in alloc.ison]
+    alloc.students = [stu for stu in alloc.students if stu in alloc.ison]
+    alloc.absorb(new)
+    return alloc
+
+
+class Fitness(object):
+    """computes Allocation.score for a whole population at once.
+
+    A population is an int matrix with one row per allocation and one
+    column per student (in the order of Allocation.students); each
+    entry is the index of a project in Allocation.projects.
+    """
+
+    def __init__(self, alloc):
+        students = alloc.students
+        projects = alloc.projects
+        self.n = len(students)
+        self.p = len(projects)
+
+        self.prefs = np.array([[stu.prefs[proj] for proj in projects]
+                               for stu in students])
+        self.prefcost = np.array([[PREFCOST[pref] for pref in row]
+                                  for row in self.prefs])
+
+        self.minstaff = np.array([proj.minstaff for proj in projects])
+        self.maxstaff = np.array([proj.maxstaff for proj in projects])
+        self.restricted = np.array([proj.restricted for proj in projects])
+
+        self.noncitizen = np.array([not stu.is_citizen for stu in students])
+        self.lowgpa = np.array([float(stu.gpa) < 3.0 for stu in students])
+
+        # map from team size to maximum number of low GPAs; sizes
+        # that aren't in GPA_LIMITS have no limit
+        self.limit = np.empty(self.n + 1, dtype=int)
+        self.limit.fill(self.n)
+        for size, limit in GPA_LIMITS.iteritems():
+            if size <= self.n:
+                self.limit[size] = limit
+
+        # one mask of students for each skill or role minimum
+        self.minimums = np.array(alloc.minimums, dtype=int)
+        self.features = [np.array([j in alloc.features[stu]
+                                   for stu in students])
+                         for j in range(len(alloc.minimums))]
+
+        # each conflict is an edge from a student to an antistu
+        index = dict((stu, i) for i, stu in enumerate(students))
+        edges = [(index[stu], index[anti]) for stu in students
+                 for anti in stu.antistus if anti in index]
+        self.edges = np.array(edges, dtype=int).reshape(-1, 2)
+
+        # each pair with an affinity appears once, with its weight
+        pairs = [(index[stu], index[stu2], w) for stu in students
+                 for stu2, w in stu.affinity.iteritems()
+                 if stu2 in index and index[stu] < index[stu2]]
+        self.pairs = np.array(pairs, dtype=int).reshape(-1, 3)
+
+    def count(self, pop, mask=None):
+        """return a matrix that maps from (allocation, project) to the
+        number of students (selected by mask) on that project"""
+        m = len(pop)
+        offset = pop + np.arange(m)[:, None] * self.p
+        if mask is not None:
+            offset = offset[:, mask]
+        counts = np.bincount(offset.ravel(), minlength=m * self.p)
+        return counts.reshape(m, self.p)
+
+    def __call__(self, pop):
+        """return an array of scores, one for each row of pop"""
+        # the preference costs add up to PREFCOST . histogram
+        total = self.prefcost[np.arange(self.n), pop].sum(axis=1)
+
+        sizes = self.count(pop)
+        total += UNDERCOST * (sizes < self.minstaff).sum(axis=1)
+        total += OVERCOST * (sizes > self.maxstaff).sum(axis=1)
+
+        non_citizens = self.count(pop, self.noncitizen)
+        total += NONCITIZENCOST * (non_citizens * self.restricted).sum(axis=1)
+
+        gpas = self.count(pop, self.lowgpa)
+        total += GPACOST * (gpas > self.limit[sizes]).sum(axis=1)
+
+        for n, mask in zip(self.minimums, self.features):
+            covered = self.count(pop, mask)
+            total += COVERAGECOST * (n - covered).clip(0).sum(axis=1)
+
+        a, b = self.edges[:, 0], self.edges[:, 1]
+        total += CONFLICTCOST * (pop[:, a] == pop[:, b]).sum(axis=1)
+
+        a, b, w = self.pairs[:, 0], self.pairs[:, 1], self.pairs[:, 2]
+        total += ((pop[:, a] != pop[:, b]) * w).sum(axis=1)
+        return total
+
+
+def encode_row(alloc):
+    """return the row that represents alloc in a population, which
+    is its snapshot"""
+    return alloc.snapshot()
+
+
+def decode_row(survey, row):
+    """make an allocation from a row of a population"""
+    alloc = Allocation(survey)
+    alloc.restore(row)
+    return alloc
+
+
+class Population(object):
+    """a population of allocations for a memetic algorithm: crossover
+    and mutation are vectorized, local improvement uses fix_and_swap.
+
+    The members start out like the allocations in optimize, from
+    generate_alloc.  Local improvement stops when time.time() passes
+    deadline (if given), and so does making members beyond the first
+    two, so a big survey can't overrun the budget.
+    """
+
+    def __init__(self, survey, size=POPULATION_SIZE, deadline=None):
+        self.survey = survey
+        self.deadline = deadline
+        self.fitness = Fitness(Allocation(survey))
+        rows = []
+        while len(rows) < size and (len(rows) < 2 or not past(deadline)):
+            rows.append(self.improve_alloc(generate_alloc(survey, 1)[1]))
+        self.pop = np.array(rows)
+        self.scores = self.fitness(self.pop)
+
+    def improve_alloc(self, alloc):
+        """apply local search to alloc and return its row"""
+        alloc.fix_understaff()
+        alloc.fix_and_swap(deadline=self.deadline)
+        return encode_row(alloc)
+
+    def best(self):
+        """return (score, row) for the best member"""
+        i = self.scores.argmin()
+        return self.scores[i], self.pop[i]
+
+    def select(self, m):
+        """choose m parents by binary tournament; return their indices"""
+        size = len(self.pop)
+        a = np.random.randint(size, size=m)
+        b = np.random.randint(size, size=m)
+        return np.where(self.scores[a] <= self.scores[b], a, b)
+
+    def crossover(self, mom, dad):
+        """make a child that keeps a random half of mom's teams intact
+        and takes the rest of its placements from dad"""
+        f = self.fitness
+        keep = np.random.random(f.p) < 0.5
+        child = np.where(keep[mom], mom, dad)
+
+        # students whose dad team is one of mom's kept teams have to
+        # go somewhere else: put them on their favorite open project
+        orphans = np.flatnonzero(~keep[mom] & keep[dad])
+        np.random.shuffle(orphans)
+        sizes = np.bincount(child, minlength=f.p)
+        sizes -= np.bincount(child[orphans], minlength=f.p)
+        for i in orphans:
+            room = ~keep & (sizes < f.maxstaff)
+            if not room.any():
+                room = ~keep
+            choices = np.flatnonzero(room)
+            j = choices[f.prefs[i, choices].argmax()]
+            child[i] = j
+            sizes[j] += 1
+        return child
+
+    def mutate(self, children):
+        """swap the placements of random pairs of students"""
+        m, n = children.shape
+        for row in children:
+            for i in np.flatnonzero(np.random.random(n) < MUTATION_RATE):
+                k = np.random.randint(n)
+                row[i], row[k] = row[k], row[i]
+
+    def generation(self):
+        """make one generation of children, improve the most promising
+        ones, and keep the best distinct members of parents and
+        children"""
+        size = len(self.pop)
+        moms = self.select(size)
+        dads = self.select(size)
+        children = np.array([self.crossover(self.pop[i], self.pop[j])
+                             for i, j in zip(moms, dads)])
+        self.mutate(children)
+        scores = self.fitness(children)
+
+        # local search is expensive, so only improve the best children
+        k = max(1, int(size * IMPROVE_FRACTION))
+        chosen = scores.argsort()[:k]
+        for i in chosen:
+            alloc = decode_row(self.survey, children[i])
+            children[i] = self.improve_alloc(alloc)
+        scores[chosen] = self.fitness(children[chosen])
+
+        pop = np.vstack([self.pop, children])
+        scores = np.concatenate([self.scores, scores])
+        _, unique = np.unique(pop, axis=0, return_index=True)
+        unique = unique[scores[unique].argsort()[:size]]
+        self.pop = pop[unique]
+        self.scores = scores[unique]
+
+
+def evolve(survey, budget, progress=None):
+    """run the memetic algorithm for budget seconds; return
+    (score, alloc) for the best allocation found.  If given, progress
+    is called with the best score after each generation."""
+    deadline = time.time() + budget
+    np.random.seed(random.getrandbits(32))
+    population = Population(survey, deadline=deadline)
+    while time.time() < deadline:
+        population.generation()
+        print 'best so far is %d\n' % population.best()[0],
+        if progress:
+            progress(population.best()[0])
+
+    score, row = population.best()
+    return score, decode_row(survey, row)
+
+
+def optimize_genetic(budget=GENETIC_BUDGET):
+    """run the memetic algorithm and save the best allocation"""
+    if np is None:
+        print 'The genetic solver requires NumPy.'
+        sys.exit()
+
+    survey = make_survey()
+    check_feasible(survey)
+    score, alloc = evolve(survey, budget)
+    alloc.pickle()
+
+
+def sweep_worker(weights):
+    """run search with the given cost weights in a worker process;
+    return (weights, score, breakdown)"""
+    global VERBOSE
+    globals().update(weights)
+    VERBOSE = False
+    random.seed()
+
+    score, assignment = search(_survey, SWEEP_BUDGET)
+    alloc = make_alloc_from(_survey, assignment)
+    return weights, score, alloc.breakdown()
+
+
+def sweep():
+    """parse the survey once, then run the optimizer for every
+    combination of weights in WEIGHT_GRID in parallel, and print
+    a table of the results"""
+    global _survey
+    _survey = make_survey()
+    check_feasible(_survey)
+
+    names = sorted(WEIGHT_GRID)
+    grid = [dict(zip(names, values)) for values in
+            itertools.product(*[WEIGHT_GRID[name] for name in names])]
+
+    pool = multiprocessing.Pool()
+    results = pool.map(sweep_worker, grid)
+    pool.close()
+
+    columns = [5, 4, 3, 2, 1, 'conflicts', 'gpa', 'coverage',
+               'noncitizens', 'under', 'over', 'unmet']
+    print '\t'.join(names + ['score'] + [str(c) for c in columns])
+    for weights, score, counts in results:
+        row = [weights[name] for name in names] + [score]
+        row += [counts.get(c, 0) for c in columns]
+        print '\t'.join(str(x) for x in row)
+
+
+def island_worker(budget, inbox, outbox, result, scores=None):
+    """run one island in a worker process.
+
+    Each member of the island is a chain of improvements like the one
+    in optimize; when a chain stops improving, it starts over.  The
+    members take turns.  Every MIGRATION_INTERVAL seconds the island
+    sends its best allocation to outbox and takes the best one waiting
+    in inbox in place of its worst member.  At the end, sends (score,
+    code) for its best allocation to result, where code is from
+    encode_alloc.  If scores is a Queue, each new best score goes on
+    it as well.
+    """
+    global VERBOSE
+    VERBOSE = False
+    random.seed()
+    survey = _survey
+    stuids = sorted(stu.stuid for stu in survey.students.values())
+
+    # each member is [score of the last local optimum, allocation]
+    members = [[float('Inf'), generate_alloc(survey, 1)[1]]
+               for i in range(ISLAND_SIZE)]
+    best = (float('Inf'), None)
+
+    deadline = time.time() + budget
+    migration = time.time() + MIGRATION_INTERVAL
+    turn = 0
+    while time.time() < deadline:
+        member = members[turn % len(members)]
+        turn += 1
+
+        alloc = member[1]
+        alloc.fix_and_swap()
+        score = alloc.score()
+        if score < best[0]:
+            best = (score, encode_alloc(alloc, stuids))
+            if scores:
+                scores.put(score)
+
+        if score >= member[0]:
+            member[:] = [float('Inf'), generate_alloc(survey, 1)[1]]
+        else:
+            member[0] = score
+            kick(alloc)
+
+        if time.time() < migration:
+            continue
+        migration = time.time() + MIGRATION_INTERVAL
+
+        outbox.send(best)
+        immigrants = []
+        while inbox.poll():
+            immigrants.append(inbox.recv())
+        if not immigrants:
+            continue
+
+        # the immigrant starts with an infinite score, so it gets
+        # kicked before it can be judged
+        score, code = min(immigrants)
+        alloc = decode_alloc(survey, stuids, code)
+        if alloc.signature not in [m[1].signature for m in members]:
+            worst = max(members, key=lambda m: m[0])
+            worst[:] = [float('Inf'), alloc]
+
+    result.send(best)
+
+
+def islands_search(survey, budget, islands=ISLANDS, progress=None):
+    """run the island model on survey for budget seconds; return
+    (score, allocation) for the best allocation found by any island.
+    If given, progress is called (in this process) with each new best
+    score of any island.
+    """
+    global _survey
+    _survey = survey
+    islands = int(islands or multiprocessing.cpu_count())
+    scores = multiprocessing.Queue() if progress else None
+
+    def report():
+        while scores and not scores.empty():
+            progress(scores.get())
+
+    # island i sends on pipes[i] and listens on pipes[i-1]
+    pipes = [multiprocessing.Pipe(False) for i in range(islands)]
+    results = [multiprocessing.Pipe(False) for i in range(islands)]
+    workers = []
+    for i in range(islands):
+        args = (budget, pipes[i-1][0], pipes[i][1], results[i][1], scores)
+        worker = multiprocessing.Process(target=island_worker, args=args)
+        worker.start()
+        workers.append(worker)
+
+    best = (float('Inf'), None)
+    for i, (conn, _) in enumerate(results):
+        while progress and not conn.poll(0.1):
+            report()
+        score, code = conn.recv()
+        print 'island %d scored %d' % (i, score)
+        best = min(best, (score, code))
+    for worker in workers:
+        worker.join()
+    report()
+
+    stuids = sorted(stu.stuid for stu in survey.students.values())
+    alloc = decode_alloc(survey, stuids, best[1])
+    return alloc.score(), alloc
+
+
+def optimize_islands(budget=ISLAND_BUDGET, islands=ISLANDS):
+    """run the island model for budget seconds and save the best
+    allocation found by any island"""
+    survey = make_survey()
+    check_feasible(survey)
+    score, alloc = islands_search(survey, budget, islands)
+    print 'best is %d' % score
+    alloc.pickle()
+
+
+def find_root(parent, x):
+    """find the representative of x in a union-find forest"""
+    while parent[x] is not x:
+        parent[x] = parent[parent[x]]
+        x = parent[x]
+    return x
+
+
+def union(parent, x, y):
+    """merge the sets that contain x and y"""
+    parent[find_root(parent, x)] = find_root(parent, y)
+
+
+def decompose(survey):
+    """split the survey into independent parts.
+
+    Students are linked to the projects they rated ELIGIBLE_PREF or
+    better (or their favorites, if there are none), to the students
+    they named as conflicts, and projects in the same PROJECT_GROUP
+    are linked to each other.  Each connected component is a part;
+    parts that can't be staffed on their own are merged with the
+    part their students like best.
+
+    Returns a list of (students, projects) pairs.
+    """
+    students = survey.students.values()
+    parent = {}
+    for x in students + survey.projects:
+        parent[x] = x
+
+    for stu in students:
+        cutoff = min(ELIGIBLE_PREF, stu.maxpref)
+        for proj in survey.projects:
+            if stu.prefs[proj] >= cutoff:
+                union(parent, stu, proj)
+        for stu2 in stu.antistus:
+            union(parent, stu, stu2)
+
+    for names in PROJECT_GROUPS:
+        projects = [survey.find_project(name) for name in names]
+        projects = [proj for proj in projects if proj]
+        for proj in projects[1:]:
+            union(parent, proj, projects[0])
+
+    parts = {}
+    for x in students + survey.projects:
+        stus, projs = parts.setdefault(find_root(parent, x), ([], []))
+        if isinstance(x, Project):
+            projs.append(x)
+        else:
+            stus.append(x)
+    parts = parts.values()
+
+    def feasible(part):
+        stus, projs = part
+        return (sum(proj.minstaff for proj in projs) <= len(stus) <=
+                sum(proj.maxstaff for proj in projs))
+
+    def affinity(part1, part2):
+        total = 0
+        for stus, projs in [(part1[0], part2[1]), (part2[0], part1[1])]:
+            for stu in stus:
+                total += max([stu.prefs[proj] for proj in projs] or [0])
+        return total
+
+    while len(parts) > 1:
+        bad = [(len(part[0]), i) for i, part in enumerate(parts)
+               if not feasible(part)]
+        if not bad:
+            break
+        _, i = min(bad)
+        part = parts.pop(i)
+        _, j = max((affinity(part, other), j)
+                   for j, other in enumerate(parts))
+        parts[j][0].extend(part[0])
+        parts[j][1].extend(part[1])
+
+    return parts
+
+
+def solve_part(args):
+    """solve one part of a decomposed survey in a worker process.
+
+    args: (index into _parts, time budget in seconds)
+    """
+    i, budget = args
+    random.seed()
+    students, projects = _parts[i]
+    sub = _survey.subset(students, projects)
+    return search(sub, budget)
+
+
+def boundary_exchange(alloc, part_of):
+    """move and swap students between parts until nobody can be made
+    happier by crossing a boundary without hurting the score.
+
+    part_of: map from Project to the index of its part
+
+    Returns the number of moves and swaps made.
+    """
+    total = 0
+    while True:
+        count = 0
+        for stu in alloc.students:
+            src = alloc.ison[stu]
+            pref = stu.prefs[src]
+            for dest in alloc.ranked[stu]:
+                if stu.prefs[dest] <= pref:
+                    break
+                if part_of[dest] == part_of[src]:
+                    continue
+                if alloc.try_move(stu, dest):
+                    count += 1
+                    break
+                bucket = alloc.cands[dest, src]
+                stus = [stu2 for p in sorted(bucket, reverse=True)
+                        for stu2 in bucket[p]]
+                if any(alloc.try_swap(stu, stu2) for stu2 in stus):
+                    count += 1
+                    break
+        total += count
+        if count == 0:
+            return total
+
+
+def optimize_decomposed(budget=DECOMPOSE_BUDGET):
+    """split the survey into parts, solve them in parallel for budget
+    seconds each, then exchange students across the boundaries and
+    save the combined allocation.
+    """
+    global _survey, _parts
+
+    survey = make_survey()
+    check_feasible(survey)
+    _survey = survey
+    _parts = decompose(survey)
+    print 'decomposed into %d parts:' % len(_parts),
+    print [len(stus) for stus, projs in _parts]
+
+    pool = multiprocessing.Pool()
+    results = pool.map(solve_part, [(i, budget) for i in range(len(_parts))])
+    pool.close()
+
+    assignment = {}
+    part_of = {}
+    for i, (score, part_assignment) in enumerate(results):
+        print 'part %d scored %d' % (i, score)
+        assignment.update(part_assignment)
+        for proj in _parts[i][1]:
+            part_of[proj] = i
+
+    alloc = make_alloc_from(survey, assignment)
+    alloc.score()
+    count = boundary_exchange(alloc, part_of)
+    print 'made %d moves across boundaries' % count
+    alloc.pickle()
 
 
 def print_allocations(filenames, dump_swaps=False):
@@ -1273,8 +3769,7 @@ def print_allocations(filenames, dump_swaps=False):
     print ''
 
     for filename in filenames:
-        fp = open(filename, 'rb')
-        alloc = pickle.load(fp)
+        alloc = load_alloc(survey, filename)
 
         if DUMP_FINAL:
             alloc.dump_final()
@@ -1290,6 +3785,199 @@ def print_allocations(filenames, dump_swaps=False):
             alloc.dump_swaps()
 
 
+def rescore_worker(filename):
+    """load a saved allocation in a worker process and score it
+    against the current survey and weights; return (score, filename,
+    breakdown, assignment)"""
+    global VERBOSE
+    VERBOSE = False
+    alloc = load_alloc(_survey, filename)
+    return alloc.score(), filename, alloc.breakdown(), alloc.assignment()
+
+
+def rescore(filenames, top=RESCORE_TOP):
+    """re-score the saved allocations in filenames in parallel
+    against the current survey and weights, print a table of them
+    from best to worst, and dump the best top"""
+    global _survey
+    _survey = make_survey()
+
+    pool = multiprocessing.Pool()
+    results = pool.map(rescore_worker, filenames)
+    pool.close()
+    results.sort()
+
+    columns = [5, 4, 3, 2, 1, 'conflicts', 'gpa', 'coverage',
+               'noncitizens', 'under', 'over', 'unmet']
+    print '\t'.join(['score', 'file'] + [str(c) for c in columns])
+    for score, filename, counts, _ in results:
+        row = [score, filename] + [counts.get(c, 0) for c in columns]
+        print '\t'.join(str(x) for x in row)
+
+    for score, filename, _, assignment in results[:top]:
+        print ''
+        print ''
+        print filename
+        alloc = make_alloc_from(_survey, assignment)
+        alloc.note_conflicts()
+        alloc.dump(_survey)
+        print ''
+
+
+def what_if(filename):
+    """load an allocation and answer questions about trades.
+
+    Commands (names are matched fuzzily; projects by name or number):
+
+    options NAME           cheapest swaps and moves for NAME
+    swap NAME1, NAME2      cost of swapping NAME1 and NAME2
+    move NAME, PROJECT     cost of moving NAME to PROJECT
+    do swap NAME1, NAME2   make the trade
+    do move NAME, PROJECT  make the trade
+    score                  print the score
+    save                   pickle the allocation
+    """
+    alloc = load_alloc(make_survey(), filename)
+    index = TradeIndex(alloc)
+
+    students = FuzzyDict(cutoff=0.6)
+    for stu in alloc.students:
+        students[stu.name.lower()] = stu
+
+    projects = FuzzyDict(cutoff=0.6)
+    for proj in alloc.projects:
+        projects[proj.name.lower()] = proj
+        projects[str(proj.i)] = proj
+
+    while True:
+        try:
+            line = raw_input('> ').strip()
+        except EOFError:
+            print ''
+            return
+
+        words = line.split(None, 1)
+        if not words:
+            continue
+        do = words[0] == 'do'
+        if do:
+            words = words[1].split(None, 1) if len(words) > 1 else []
+        cmd = words[0] if words else ''
+        args = [arg.strip().lower() for arg in words[1].split(',')
+                ] if len(words) > 1 else []
+
+        try:
+            if cmd == 'options' and len(args) == 1:
+                index.dump_options(students[args[0]])
+            elif cmd == 'swap' and len(args) == 2:
+                stu1, stu2 = students[args[0]], students[args[1]]
+                print index.cost_swap(stu1, stu2)
+                if do:
+                    index.swap(stu1, stu2)
+            elif cmd == 'move' and len(args) == 2:
+                stu, proj = students[args[0]], projects[args[1]]
+                print index.cost_move(stu, proj)
+                if do:
+                    index.move(stu, proj)
+            elif cmd == 'score':
+                alloc.score(True)
+            elif cmd == 'save':
+                alloc.pickle()
+            else:
+                print what_if.__doc__
+        except KeyError, e:
+            print 'No match for', e
+
+
+def placement_matrix(allocs):
+    """return (stuids, matrix), where matrix has one row for each
+    allocation and one column for each student id in stuids; each
+    entry is the index (proj.i) of the student's project, or 0 if
+    the student is not in the allocation"""
+    stuids = set()
+    for alloc in allocs:
+        stuids.update(stu.stuid for stu in alloc.students)
+    stuids = sorted(stuids)
+
+    index = dict((stuid, j) for j, stuid in enumerate(stuids))
+    matrix = np.zeros((len(allocs), len(stuids)), dtype=int)
+    for i, alloc in enumerate(allocs):
+        for stuid, proj_i in alloc.assignment().iteritems():
+            matrix[i, index[stuid]] = proj_i
+    return stuids, matrix
+
+
+def distance_matrix(matrix):
+    """return the number of students placed differently in each pair
+    of rows of a placement matrix"""
+    m = len(matrix)
+    dists = np.empty((m, m), dtype=int)
+    for i in range(m):
+        dists[i] = (matrix != matrix[i]).sum(axis=1)
+    return dists
+
+
+def cluster_allocations(filenames, radius=CLUSTER_RADIUS):
+    """load the allocations in filenames and group the ones that are
+    minor variations of each other.  Going through them from best to
+    worst score, each one joins the first cluster whose best member
+    is within radius placements; otherwise it starts a new cluster.
+    For each cluster, print the best member, the others, and the
+    students whose placement differs within the cluster."""
+    global VERBOSE
+    if np is None:
+        print 'Clustering requires NumPy.'
+        sys.exit()
+
+    VERBOSE = False
+    survey = make_survey()
+    allocs = []
+    for filename in filenames:
+        alloc = load_alloc(survey, filename)
+        allocs.append((alloc.score(), filename, alloc))
+    allocs.sort()
+
+    stuids, matrix = placement_matrix([alloc for _, _, alloc in allocs])
+    dists = distance_matrix(matrix)
+
+    clusters = []
+    for i in range(len(allocs)):
+        for cluster in clusters:
+            if dists[cluster[0], i] <= radius:
+                cluster.append(i)
+                break
+        else:
+            clusters.append([i])
+
+    names = {}
+    projects = {}
+    for _, _, alloc in allocs:
+        for stu in alloc.students:
+            names[stu.stuid] = stu.name
+        for proj in alloc.projects:
+            projects[proj.i] = proj
+
+    print '%d allocations in %d clusters' % (len(allocs), len(clusters))
+    for cluster in clusters:
+        rep = cluster[0]
+        score, filename, _ = allocs[rep]
+        print '\n%s (score %d, %d members)' % (filename, score, len(cluster))
+        for i in cluster[1:]:
+            print '    %s (score %d, distance %d)' % (allocs[i][1],
+                                                     allocs[i][0],
+                                                     dists[rep, i])
+
+        rows = matrix[cluster]
+        varies = np.flatnonzero((rows != rows[0]).any(axis=0))
+        for j in varies:
+            placements = Hist()
+            for proj_i in rows[:, j]:
+                placements.count(projects.get(proj_i))
+            print '   ', names[stuids[j]], ':',
+            print ', '.join('%s x%d' % (proj, count)
+                            for proj, count in placements.iteritems())
+
+
 def print_summary():
     """print a summary of the survey data"""
     survey = make_survey()
@@ -1316,10 +4004,29 @@ def main(script, *args):
         except KeyboardInterrupt:
             print 'done'
 
+    elif args[0] == 'resume':
+        try:
+            resume()
+        except KeyboardInterrupt:
+            print 'done'
     elif args[0] == 'tokens':
         process_tokens()
     elif args[0] == 'summary':
         print_summary()
+    elif args[0] == 'decompose':
+        optimize_decomposed(*[float(arg) for arg in args[1:]])
+    elif args[0] == 'genetic':
+        optimize_genetic(*[float(arg) for arg in args[1:]])
+    elif args[0] == 'whatif':
+        what_if(args[1])
+    elif args[0] == 'sweep':
+        sweep()
+    elif args[0] == 'cluster':
+        cluster_allocations(args[1:])
+    elif args[0] == 'rescore':
+        rescore(args[1:])
+    elif args[0] == 'islands':
+        optimize_islands(*[float(arg) for arg in args[1:]])
     else:
         print_allocations(args, DUMP_SWAPS)
 